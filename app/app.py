@@ -1,13 +1,27 @@
-from flask import Flask, request, jsonify, abort, Response
+from flask import Flask, request, jsonify, abort, Response, stream_with_context, url_for, g
+from urllib import urlencode
 import json
+import os
 import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import exc
+from psycopg2.extensions import QueryCanceledError
 from flasgger import Swagger
 from config import generate_config
-from models import db
+from models import db, parse_fields
+from labels import parse_selector
 from backends.gcloud import validate_token
-
-from methods import generate_resource_methods
+from cache import TTLCache
+from idtokens import generate_id_token_verifier, is_jwt
+from waiters import AllocationQueue
+from reconciler import generate_reconciler
+from pool import generate_warm_pool
+from operations import OperationRegistry
+from leases import generate_lease_sweeper
+from metrics import REGISTRY, CONTENT_TYPE, instrument_app
+
+from methods import generate_resource_methods, encode_cursor, decode_cursor, SEARCH_MODES
 from checkers import generate_request_checker
 
 swagger_config = {
@@ -30,15 +44,86 @@ swagger_config = {
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
+if app.config['METRICS_ENABLED']:
+    instrument_app(app)
 Swagger(app, config=swagger_config, template_file='swagger/swagger_template.yml')
 db.init_app(app)
 backend_config = generate_config(app.config['RESOURCE_BACKEND'])
 resource_methods = generate_resource_methods(app.config['RESOURCE_BACKEND'], backend_config)
 check_request = generate_request_checker(app.config['RESOURCE_BACKEND'])
+token_cache = TTLCache(maxsize=app.config['TOKEN_CACHE_SIZE'], ttl=app.config['TOKEN_CACHE_TTL'])
+authz_cache = TTLCache(maxsize=app.config['AUTHZ_CACHE_SIZE'], ttl=app.config['AUTHZ_CACHE_TTL'])
+# who each token belonged to, kept past TOKEN_CACHE_TTL so a revalidated token's cached decision is still found
+token_users = TTLCache(maxsize=app.config['TOKEN_CACHE_SIZE'], ttl=app.config['AUTHZ_CACHE_TTL'])
+auth_pool = ThreadPoolExecutor(max_workers=app.config['AUTH_WORKERS'])
+id_token_verifier = generate_id_token_verifier(app.config['AUTH_MODE'],
+                                               audience=app.config['ID_TOKEN_AUDIENCE'],
+                                               certs_url=app.config['ID_TOKEN_CERTS_URL'])
+reconciler = generate_reconciler(app.config['RESOURCE_BACKEND'], app, backend_config, app.config['RECONCILE_INTERVAL'])
+warm_pool = generate_warm_pool(app.config['RESOURCE_BACKEND'], app, resource_methods, backend_config, app.config)
+operations = OperationRegistry(app, workers=app.config['OPERATION_WORKERS'],
+                               retention=app.config['OPERATION_RETENTION'])
+lease_sweeper = generate_lease_sweeper(app, resource_methods, app.config['LEASE_SWEEP_INTERVAL'])
+allocation_queue = AllocationQueue(poll_interval=app.config['ALLOCATE_POLL_INTERVAL'])
+if id_token_verifier and app.config['RESOURCE_BACKEND'] == 'gce':
+    print "[WARN] Compute editor checks need OAuth access tokens; ID tokens will only pass cached decisions."
+
+
+def start_background_workers():
+    """Starts the threads of the process serving requests. Importing app, as manage.py does, starts none."""
+    if reconciler and app.config['RECONCILE_IN_PROCESS']:
+        reconciler.start()
+    if warm_pool and app.config['WARM_POOL_IN_PROCESS']:
+        warm_pool.start()
+    if lease_sweeper:
+        lease_sweeper.start()
+    allocation_queue.start(app.config['SQLALCHEMY_DATABASE_URI'])
 
 
 ## Authentication & Authorization ##
 
+def token_key(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def authenticate(access_token):
+    """Returns the email for an access token, or None if it was rejected.
+    Results (including rejections) are cached by a hash of the token so
+    the userinfo round trip only happens once per TTL.
+    In idtoken mode, JWT ID tokens are verified locally instead."""
+    if id_token_verifier and is_jwt(access_token):
+        return id_token_verifier.validate_token(access_token)
+
+    key = token_key(access_token)
+    userid = token_cache.get(key)
+    if userid is None:
+        userid = validate_token(access_token) or False
+        if userid:
+            token_cache.set(key, userid)
+            token_users.set(key, userid)
+        else:
+            token_cache.set(key, userid, ttl=app.config['TOKEN_CACHE_NEGATIVE_TTL'])
+    return userid or None
+
+
+def authorize(userid, access_token, pending=None):
+    """Returns whether a user may manage compute instances in OAUTH_PROJECT.
+    Decisions are cached per (user, project); `pending` is an already
+    submitted is_authorized call whose result is used on a cache miss."""
+    key = (userid, app.config['OAUTH_PROJECT'])
+    allowed = authz_cache.get(key)
+    if allowed is None:
+        if id_token_verifier and is_jwt(access_token):
+            # ID tokens cannot be used to test IAM permissions; only cached decisions apply
+            return False
+        if pending:
+            allowed = pending.result()
+        else:
+            allowed = backend_config.is_authorized(access_token, app.config['OAUTH_PROJECT'])
+        authz_cache.set(key, allowed)
+    return allowed
+
+
 def authorized(fn):
     """Decorator that checks that requests
     contain an id-token in the request header.
@@ -61,41 +146,219 @@ def authorized(fn):
             return None
 
         print("Checking token...")
-        userid = validate_token(request.headers['Authorization'])
+        access_token = request.headers['Authorization']
+        pending = None
+        if app.config['RESOURCE_BACKEND'] == 'gce' and not (id_token_verifier and is_jwt(access_token)):
+            key = token_key(access_token)
+            known_user = token_users.get(key)
+            if key not in token_cache and (known_user is None or
+                                           (known_user, app.config['OAUTH_PROJECT']) not in authz_cache):
+                # token needs validating and there is no decision to reuse;
+                # check permissions while the token itself is validated
+                pending = auth_pool.submit(backend_config.is_authorized, access_token, app.config['OAUTH_PROJECT'])
+
+        userid = authenticate(access_token)
         if not userid:
+            if pending:
+                pending.cancel()
             print("Authentication returned FAIL!")
             # Unauthorized
             abort(401)
             return None
         if app.config['RESOURCE_BACKEND'] == 'gce':
-            if not backend_config.is_authorized(request.headers['Authorization'], app.config['OAUTH_PROJECT']):
+            if not authorize(userid, access_token, pending=pending):
                 print("Authorization returned FAIL!")
                 # Unauthorized
                 abort(401)
                 return None
 
+        g.userid = userid
         return fn(*args, **kwargs)
     _wrap.func_name = fn.func_name
     return _wrap
 
 
+def authenticated(fn):
+    """Decorator like authorized that only checks the token is valid, not what its user may do;
+    for routes a user must be able to reach before they are authorized."""
+
+    def _wrap(*args, **kwargs):
+        if 'Authorization' not in request.headers:
+            print("No token in header")
+            abort(401)
+        userid = authenticate(request.headers['Authorization'])
+        if not userid:
+            print("Authentication returned FAIL!")
+            abort(401)
+        g.userid = userid
+        return fn(*args, **kwargs)
+    _wrap.func_name = fn.func_name
+    return _wrap
+
+
+## Responses ##
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def list_response(resources, limit=None):
+    """Serializes (id, resource) pairs as they are read, either as newline delimited JSON
+    or as one JSON array. With a page `limit`, the page is read up front so a cursor for
+    the next page can be returned in the X-Next-Cursor and Link headers."""
+    headers = {}
+    if limit:
+        resources = list(resources)
+        if len(resources) == limit:
+            cursor = encode_cursor(resources[-1][0])
+            args = request.args.to_dict()
+            args['after'] = cursor
+            headers['X-Next-Cursor'] = cursor
+            headers['Link'] = '<{0}?{1}>; rel="next"'.format(request.base_url, urlencode(args))
+
+    if wants_ndjson():
+        body = (json.dumps(r) + '\n' for _, r in resources)
+        mimetype = 'application/x-ndjson'
+    else:
+        body = json_array(r for _, r in resources)
+        mimetype = 'application/json'
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers), 200
+
+
+def wants_async():
+    return request.args.get('async') == 'true'
+
+
+def accepted(op):
+    return jsonify(op.map()), 202, {'Location': url_for('api_get_operation', op_id=op.id)}
+
+
+def json_array(items):
+    yield '['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item)
+    yield ']'
+
+
+def page_limit():
+    """The page size from the `limit` query parameter, or None for no paging.
+    Raises ValueError if it is not a whole number between 1 and MAX_PAGE_SIZE."""
+    if 'limit' not in request.args:
+        return None
+    limit = request.args.get('limit', type=int)
+    if limit is None or not 0 < limit <= app.config['MAX_PAGE_SIZE']:
+        raise ValueError("limit must be between 1 and {0}".format(app.config['MAX_PAGE_SIZE']))
+    return limit
+
+
+def lease_ttl(name='lease'):
+    """Seconds an allocation's lease should last, from a query parameter or LEASE_TTL.
+    0 means no lease. Raises ValueError if it is not a whole number of seconds within range."""
+    ttl = int(request.args.get(name, app.config['LEASE_TTL']))
+    if not 0 <= ttl <= app.config['MAX_LEASE_TTL']:
+        raise ValueError("{0} must be between 0 and {1} seconds".format(name, app.config['MAX_LEASE_TTL']))
+    return ttl
+
+
+## Operations ##
+# run on the operation workers, inside an app context
+
+def create_resource(body):
+    resource_methods.create_resource(body)
+    print "Created record for {0}".format(body['name'])
+    return body
+
+
+def update_resource(name, body):
+    resource_methods.update_resource(name, body)
+    return resource_methods.get_resource_by_name(name).map()
+
+
+def bulk_action(action, names, project):
+    results = resource_methods.bulk_action(action, names, project=project)
+    return {"succeeded": sorted(n for n, e in results.items() if e is None),
+            "failed": dict((n, e) for n, e in results.items() if e is not None)}
+
+
+## Metrics ##
+
+def collect_metrics():
+    """Gauges and counters read from the rest of the app on every scrape."""
+    resources = []
+    for project, counts in sorted(resource_methods.pool_counts().items()):
+        for state, n in sorted(counts.items()):
+            resources.append(({"project": project, "state": state}, n))
+    waiting = [({"project": p or ""}, n) for p, n in sorted(allocation_queue.waiting_counts().items())]
+    caches = [({"cache": "token"}, token_cache), ({"cache": "authz"}, authz_cache)]
+    metrics = [("jacalloc_resources", "gauge",
+                "Resources per project that are free, in use, or in use past their lease or timeout", resources),
+               ("jacalloc_allocations_waiting", "gauge", "Allocations waiting for a resource to be released", waiting),
+               ("jacalloc_cache_hits_total", "counter", "Auth cache lookups that were hits",
+                [(l, c.hits) for l, c in caches]),
+               ("jacalloc_cache_misses_total", "counter", "Auth cache lookups that were misses",
+                [(l, c.misses) for l, c in caches])]
+    poller = getattr(backend_config, 'operation_poller', None)
+    if poller:
+        metrics.append(("jacalloc_gce_operations_pending", "gauge", "Google operations being polled",
+                        [({}, poller.pending())]))
+    return metrics
+
+
+if app.config['METRICS_ENABLED']:
+    REGISTRY.add_collector(collect_metrics)
+
+
 ## Routes ##
 
+@app.route('/auth/cache', methods=['DELETE'])
+@authenticated
+def api_invalidate_authz():
+    # users may clear their own decision, even a cached denial; clearing anyone else's, or all of them,
+    # is for AUTH_ADMINS
+    user = request.args.get('user')
+    is_admin = g.userid in app.config['AUTH_ADMINS']
+    if user and (user == g.userid or is_admin):
+        authz_cache.invalidate((user, app.config['OAUTH_PROJECT']))
+        return "Cleared cached authorization for {0}".format(user), 204
+    if not is_admin:
+        return "Only AUTH_ADMINS may clear other users' authorizations", 403
+    authz_cache.clear()
+    return "Cleared all cached authorizations", 204
+
+
 @app.route('/')
 def api_health():
     # TODO: check if can ping db
     return 'Service running!', 200
 
 
+@app.route('/metrics')
+def api_metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE), 200
+
+
 @app.route('/resources', methods=['GET', 'POST'])
 @authorized
 def api_create_resource():
     if request.method == 'GET':
-        resp = resource_methods.get_all_resources(in_use=request.args.get('in_use'),
-                                                  project=request.args.get('project'),
-                                                  private=request.args.get('private'),
-                                                  usable=request.args.get('usable'))
-        return Response(json.dumps(resp), mimetype='application/json'), 200
+        try:
+            limit = page_limit()
+            after = decode_cursor(request.args['after']) if 'after' in request.args else None
+            fields = parse_fields(request.args.get('fields'))
+            selector = parse_selector(request.args.get('selector'))
+        except ValueError as e:
+            return str(e), 400
+
+        resources = resource_methods.iter_resources(after=after, limit=limit, fields=fields,
+                                                    in_use=request.args.get('in_use'),
+                                                    project=request.args.get('project'),
+                                                    private=request.args.get('private'),
+                                                    usable=request.args.get('usable'),
+                                                    selector=selector)
+        return list_response(resources, limit=limit)
 
     elif request.method == 'POST':
         body = request.get_json()
@@ -109,11 +372,17 @@ def api_create_resource():
         else:
             # new resource
             if not resource_methods.get_resource_by_name(name=body['name']):
+                if wants_async():
+                    return accepted(operations.submit('create', body['name'], create_resource, body))
                 try:
                     resource_methods.create_resource(body)
                     print "Created record for {0}".format(body['name'])
                     return jsonify(body), 201
 
+                except exc.IntegrityError:
+                    # lost a race with a concurrent create of the same (project, name)
+                    db.session.rollback()
+                    return "Resource already exists!", 409
                 except:
                     _, exc_value, _ = sys.exc_info()
                     errors = "Unable to create new record for {0}: {1}".format(body['name'], exc_value)
@@ -142,15 +411,32 @@ def api_get_resource(name):
 @app.route('/resources/name/<keyword>', methods=['GET'])
 @authorized
 def api_get_by_search(keyword):
+    mode = request.args.get('mode', 'substring')
+    if mode not in SEARCH_MODES:
+        return "mode must be one of {0}".format(", ".join(SEARCH_MODES)), 400
     try:
-        resp = resource_methods.list_resources_by_keyword(keyword)
-        if resp:
-            return Response(json.dumps([x.map() for x in resp.all()]), mimetype='application/json'), 200
-        else:
-            return "No resources found matching regex!", 404
+        limit = page_limit()
+        after = decode_cursor(request.args['after']) if 'after' in request.args else None
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return str(e), 400
 
+    try:
+        # read here, where a bad keyword or a regex timeout can still be turned into a 400,
+        # rather than while the response is being streamed
+        resources = list(resource_methods.search_resources(keyword, mode=mode, after=after, limit=limit,
+                                                           fields=fields,
+                                                           regex_timeout=app.config['SEARCH_REGEX_TIMEOUT']))
     except exc.DataError as e:
+        db.session.rollback()
         return ("Invalid keyword \"{0}\". Try removing bad characters.".format(keyword, e)), 400
+    except exc.OperationalError as e:
+        db.session.rollback()
+        if isinstance(e.orig, QueryCanceledError):
+            return "Regex \"{0}\" took longer than {1}ms. Try a simpler pattern or another mode.".format(
+                keyword, app.config['SEARCH_REGEX_TIMEOUT']), 400
+        raise
+    return list_response(resources, limit=limit)
 
 
 @app.route('/resources/<name>', methods=['POST'])
@@ -168,6 +454,8 @@ def api_update_resource(name):
         if not errors:
             if not check_request.if_can_update_attr(body, resp.map()):
                 return "Resource is not usable!  Cannot update.", 405
+            elif wants_async():
+                return accepted(operations.submit('update', name, update_resource, name, body))
             else:
                 try:
                     resource_methods.update_resource(name, body)
@@ -190,6 +478,8 @@ def api_update_resource(name):
 @app.route('/resources/<name>', methods=['DELETE'])
 @authorized
 def api_delete_resource(name):
+    if wants_async():
+        return accepted(operations.submit('delete', name, resource_methods.delete_resource, name))
     try:
         resource_methods.delete_resource(name)
         return "Deleted resource {0}".format(name), 204
@@ -198,39 +488,179 @@ def api_delete_resource(name):
         return str(e), 500
 
 
+@app.route('/resources/batch', methods=['POST'])
+@authorized
+def api_batch():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return "Request body must be a non-empty list of changes", 400
+    if len(items) > app.config['MAX_BATCH_CHANGES']:
+        return "At most {0} changes can be made at once".format(app.config['MAX_BATCH_CHANGES']), 400
+
+    errors = check_request.check_request_batch(items)
+    if errors:
+        results = [{"index": i, "status": 400, "error": e} for i, e in sorted(errors.items())]
+        return jsonify(committed=False, results=results), 400
+    try:
+        committed, results = resource_methods.apply_batch(items, can_update=check_request.if_can_update_attr)
+    except NotImplementedError as e:
+        return str(e), 501
+    except exc.IntegrityError:
+        # lost a race with a concurrent create of one of the same resources
+        db.session.rollback()
+        return "A resource in the batch was created concurrently; nothing was changed", 409
+    except:
+        db.session.rollback()
+        e = sys.exc_info()[1]
+        return str(e), 500
+    return jsonify(committed=committed, results=results), 200 if committed else 409
+
+
+@app.route('/resources/bulk/<action>', methods=['POST'])
+@authorized
+def api_bulk_action(action):
+    if action not in ('start', 'stop', 'delete'):
+        return "Unknown action {0}; must be one of start, stop or delete".format(action), 404
+    body = request.get_json(silent=True) or {}
+    names = body.get('names')
+    if not isinstance(names, list) or not names or not all(isinstance(n, basestring) for n in names):
+        return "Request body must have a non-empty list of resource names", 400
+    names = list(set(names))
+    if len(names) > app.config['MAX_BULK_ACTION']:
+        return "At most {0} resources can be changed at once".format(app.config['MAX_BULK_ACTION']), 400
+
+    if wants_async():
+        return accepted(operations.submit(action, ",".join(sorted(names)), bulk_action, action, names, body.get('project')))
+    try:
+        return jsonify(bulk_action(action, names, body.get('project'))), 200
+    except:
+        e = sys.exc_info()[1]
+        return str(e), 500
+
+
+@app.route('/operations/<op_id>', methods=['GET'])
+@authorized
+def api_get_operation(op_id):
+    op = operations.get(op_id)
+    if not op:
+        return "Operation not found!", 404
+    try:
+        wait = min(float(request.args.get('wait', 0)), app.config['MAX_OPERATION_WAIT'])
+    except ValueError:
+        return "wait must be a number of seconds", 400
+    if wait > 0:
+        op.done.wait(wait)
+    return jsonify(op.map()), 200
+
+
 @app.route('/resources/allocate', methods=['POST'])
 @authorized
 def api_allocate():
+    project = request.args.get('project')
+    try:
+        wait = min(float(request.args.get('wait', 0)), app.config['MAX_ALLOCATE_WAIT'])
+    except ValueError:
+        return "wait must be a number of seconds", 400
+    try:
+        ttl = lease_ttl()
+        selector = parse_selector(request.args.get('selector'))
+    except ValueError as e:
+        return str(e), 400
 
-    free = resource_methods.get_all_resources(in_use="false", project=request.args.get('project'),
-                                              private="false", usable="true")
-    if free:
-        try:
-            allocated = resource_methods.pick_random_resource(free)
-            resource_methods.update_resource(allocated['name'], {'in_use': True})
-            allocated['in_use'] = True
-            return jsonify(allocated), 200
-        except:
-            e = sys.exec_info()[1]
-            return str(e), 500
+    try:
+        if wait > 0:
+            # hold the request in line until a resource is released or the wait runs out
+            allocated = allocation_queue.wait(
+                lambda: resource_methods.claim_resource(project=project, lease_ttl=ttl, selector=selector),
+                wait, project=project, selector=request.args.get('selector') or None)
+        else:
+            allocated = resource_methods.claim_resource(project=project, lease_ttl=ttl, selector=selector)
+    except:
+        e = sys.exc_info()[1]
+        return str(e), 500
+    if allocated:
+        return jsonify(allocated.lease_map()), 200
     else:
         return "No resources are free!", 412
 
 
+@app.route('/resources/allocate/batch', methods=['POST'])
+@authorized
+def api_allocate_batch():
+    try:
+        count = int(request.args.get('count', 1))
+    except ValueError:
+        return "count must be an integer", 400
+    if not 0 < count <= app.config['MAX_BATCH_ALLOCATE']:
+        return "count must be between 1 and {0}".format(app.config['MAX_BATCH_ALLOCATE']), 400
+    mode = request.args.get('mode', 'all')
+    if mode not in ('all', 'best_effort'):
+        return "mode must be one of 'all' or 'best_effort'", 400
+    try:
+        ttl = lease_ttl()
+        selector = parse_selector(request.args.get('selector'))
+    except ValueError as e:
+        return str(e), 400
+
+    try:
+        allocated = resource_methods.claim_resources(count, project=request.args.get('project'),
+                                                     all_or_nothing=(mode == 'all'), lease_ttl=ttl,
+                                                     selector=selector)
+    except:
+        e = sys.exc_info()[1]
+        return str(e), 500
+    if allocated:
+        return Response(json.dumps([r.lease_map() for r in allocated]), mimetype='application/json'), 200
+    else:
+        return "Not enough resources are free!", 412
+
+
+@app.route('/leases/<lease_id>/heartbeat', methods=['POST'])
+@authorized
+def api_renew_lease(lease_id):
+    try:
+        ttl = lease_ttl('ttl')
+    except ValueError as e:
+        return str(e), 400
+    if not ttl:
+        return "ttl (seconds) is required when no LEASE_TTL is configured", 400
+    expires = resource_methods.renew_lease(lease_id, ttl)
+    if not expires:
+        return "Lease not found or already expired!", 404
+    return jsonify(lease_id=lease_id, lease_expires=expires.isoformat()), 200
+
+
+@app.route('/leases/<lease_id>', methods=['DELETE'])
+@authorized
+def api_release_lease(lease_id):
+    if not resource_methods.release_lease(lease_id):
+        return "Lease not found!", 404
+    return "Released lease {0}".format(lease_id), 204
+
+
 @app.route('/resources/allocate/timeout', methods=['GET'])
 @authorized
 def api_get_timeouts():
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return str(e), 400
+
     try:
         r = resource_methods.get_all_resources(in_use="true",
                                                project=request.args.get("project"),
                                                private=request.args.get("private"),
-                                               expired=int(request.args.get("timeout")))
+                                               expired=request.args.get("timeout", type=int),
+                                               fields=fields)
         return Response(json.dumps(r), mimetype="application/json"), 200
 
     except:
-        _, e, _ = sys.exec_info()
+        _, e, _ = sys.exc_info()
         return str(e), 500
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    # the reloader runs this file twice: in a parent that only watches for changes, and in the child that serves
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+    app.run(debug=True, host='0.0.0.0', threaded=True)
@@ -1,8 +1,16 @@
 from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 import sys, os
+import threading
 import time
 import requests
+import httplib2
+from metrics import timed, outbound
+
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest"
+COMPUTE_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+_discovery_docs = {}
+_discovery_lock = threading.Lock()
 
 
 # return the credentials of a service account
@@ -10,20 +18,84 @@ def get_service_acct_creds(creds_json):
     return ServiceAccountCredentials.from_json_keyfile_name(creds_json)
 
 
-# return an instance of Google Compute Engine
-def create_compute_instance(credentials):
-    return build('compute', 'v1', credentials=credentials)
-
-
-def create_compute_instance_from_json_creds(creds_json):
-    c = get_service_acct_creds(creds_json)
-    return create_compute_instance(c)
-
-
-def create_instance(compute, project, zone, name, tags, disk_size="100", disk_type="pd-ssd", machine_type="n1-standard-8"):
-    image_response = compute.images().getFromFamily(
-        project='ubuntu-os-cloud', family='ubuntu-1604-lts').execute()
-    source_disk_image = image_response['selfLink']
+# return an api's discovery document, fetched at most once per process. With cache_dir it is also
+# kept on disk and reused for max_age seconds, so new workers build clients without any network calls
+def get_discovery_doc(api, version, cache_dir=None, max_age=86400):
+    key = (api, version)
+    with _discovery_lock:
+        if key in _discovery_docs:
+            return _discovery_docs[key]
+        path = os.path.join(cache_dir, "{0}.{1}.json".format(api, version)) if cache_dir else None
+        fresh = path and os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age
+        try:
+            if fresh:
+                with open(path) as f:
+                    doc = f.read()
+            else:
+                with outbound('get_discovery_doc'):
+                    resp = requests.get(DISCOVERY_URL.format(api=api, version=version), timeout=30)
+                    resp.raise_for_status()
+                doc = resp.text
+                if path:
+                    tmp = "{0}.{1}".format(path, os.getpid())
+                    with open(tmp, "w") as f:
+                        f.write(doc.encode("utf-8"))
+                    os.rename(tmp, path)
+        except (IOError, OSError, requests.RequestException):
+            if not (path and os.path.exists(path)):
+                raise
+            # a stale document beats no client at all
+            with open(path) as f:
+                doc = f.read()
+        _discovery_docs[key] = doc
+        return doc
+
+
+class PooledHttp:
+    """Stands in for an authorized httplib2.Http. An Http connection is not thread safe, so each
+    request borrows one of at most `size` authorized connections, letting every thread share one
+    compute client. `credentials` is exposed so batch requests can authorize their parts."""
+
+    def __init__(self, credentials, size=8):
+        self.credentials = credentials
+        self._free = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def request(self, *args, **kwargs):
+        with self._slots:
+            with self._lock:
+                http = self._free.pop() if self._free else None
+            if http is None:
+                http = self.credentials.authorize(httplib2.Http())
+            try:
+                return http.request(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._free.append(http)
+
+
+# return an instance of Google Compute Engine. With `connections`, the client is safe to share
+# between threads and makes at most that many requests at once
+def create_compute_instance(credentials, discovery_cache_dir=None, connections=None):
+    doc = get_discovery_doc('compute', 'v1', discovery_cache_dir)
+    if not connections:
+        return build_from_document(doc, credentials=credentials)
+    if credentials.create_scoped_required():
+        credentials = credentials.create_scoped(COMPUTE_SCOPES)
+    return build_from_document(doc, http=PooledHttp(credentials, connections))
+
+
+@timed
+def get_image_from_family(compute, image_project, family):
+    return compute.images().getFromFamily(
+        project=image_project, family=family).execute()
+
+
+def create_instance(compute, project, zone, name, tags, disk_size="100", disk_type="pd-ssd", machine_type="n1-standard-8",
+                    source_disk_image=None):
+    if not source_disk_image:
+        source_disk_image = get_image_from_family(compute, 'ubuntu-os-cloud', 'ubuntu-1604-lts')['selfLink']
     network = 'managed' if project == 'broad-dsde-dev' else 'default'
 
     config = {
@@ -70,12 +142,14 @@ def create_instance(compute, project, zone, name, tags, disk_size="100", disk_ty
         }
     }
 
-    return compute.instances().insert(
-        project=project,
-        zone=zone,
-        body=config).execute()
+    with outbound('create_instance'):
+        return compute.instances().insert(
+            project=project,
+            zone=zone,
+            body=config).execute()
 
 
+@timed
 def delete_instance(compute, project, zone, name):
     return compute.instances().delete(
         project=project,
@@ -84,6 +158,7 @@ def delete_instance(compute, project, zone, name):
 
 
 # returns list of instances that satisfies the given filters
+@timed
 def list_instances(compute, project, zone, name=None, tags=None):
     instances = compute.instances().list(project=project, zone=zone).execute()
     result = instances['items']
@@ -94,6 +169,27 @@ def list_instances(compute, project, zone, name=None, tags=None):
     return result
 
 
+# returns every instance in a zone, following pagination
+def list_all_instances(compute, project, zone):
+    instances = []
+    request = compute.instances().list(project=project, zone=zone)
+    while request is not None:
+        with outbound('list_all_instances'):
+            response = request.execute()
+        instances.extend(response.get('items', []))
+        request = compute.instances().list_next(previous_request=request, previous_response=response)
+    return instances
+
+
+# the external ip of an instance, or None if it has none (e.g. it is stopped)
+def nat_ip(instance):
+    try:
+        return str(instance['networkInterfaces'][0]['accessConfigs'][0]['natIP'])
+    except (KeyError, IndexError):
+        return None
+
+
+@timed
 def start_instance(compute, project, zone, name):
     return compute.instances().start(
         project=project,
@@ -101,6 +197,7 @@ def start_instance(compute, project, zone, name):
         instance=name).execute()
 
 
+@timed
 def stop_instance(compute, project, zone, name):
     return compute.instances().stop(
         project=project,
@@ -108,6 +205,7 @@ def stop_instance(compute, project, zone, name):
         instance=name).execute()
 
 
+@timed
 def reset_instance(compute, project, zone, name):
     return compute.instances().reset(
         project=project,
@@ -115,6 +213,30 @@ def reset_instance(compute, project, zone, name):
         instance=name).execute()
 
 
+# most calls google accepts in one batch request
+BATCH_LIMIT = 1000
+
+
+# sends `action` ('start', 'stop' or 'delete') for many instances in as few batch requests as possible.
+# returns {name: (operation, None)} for accepted calls and {name: (None, HttpError)} for rejected ones
+def batch_instance_action(compute, project, zone, action, names, batch_size=BATCH_LIMIT):
+    names = list(names)
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for i in range(0, len(names), batch_size):
+        batch = compute.new_batch_http_request(callback=callback)
+        for name in names[i:i + batch_size]:
+            method = getattr(compute.instances(), action)
+            batch.add(method(project=project, zone=zone, instance=name), request_id=name)
+        with outbound('batch_instance_action'):
+            batch.execute()
+    return results
+
+
+@timed
 def get_instance(compute, project, zone, name):
     return compute.instances().get(
         project=project,
@@ -128,25 +250,23 @@ def get_instance_status(compute, project, zone, name):
     return instance['status']
 
 
-def wait_for_operation(compute, project, zone, operation):
-    sys.stdout.write('Waiting for operation to finish')
-    while True:
-        result = compute.zoneOperations().get(
-            project=project,
-            zone=zone,
-            operation=operation).execute()
-
-        if result['status'] == 'DONE':
-            print("done.")
-            if 'error' in result:
-                raise Exception(result['error'])
-            return result
-        else:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            time.sleep(1)
+# returns the named zone operations, with one list call per `chunk` names
+def list_operations(compute, project, zone, names, chunk=50):
+    names = list(names)
+    operations = []
+    for i in range(0, len(names), chunk):
+        # operation names are [a-z0-9-], so they can be matched with a regex filter as they are
+        request = compute.zoneOperations().list(project=project, zone=zone,
+                                                filter="name eq '({0})'".format("|".join(names[i:i + chunk])))
+        while request is not None:
+            with outbound('list_operations'):
+                response = request.execute()
+            operations.extend(response.get('items', []))
+            request = compute.zoneOperations().list_next(previous_request=request, previous_response=response)
+    return operations
 
 
+@timed
 def validate_token(access_token):
     '''Verifies that an access-token is valid and
     meant for this app.
@@ -165,6 +285,7 @@ def validate_token(access_token):
     return resp.json()['email']
 
 
+@timed
 def is_compute_editor(access_token, project):
     '''Verifies that the user linked to an access-token has the right
     permissions to create and delete compute instances in the given project
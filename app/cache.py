@@ -0,0 +1,68 @@
+"""
+TTLCache class
+
+A small thread-safe LRU cache whose entries expire after a time-to-live.
+Used to avoid repeating slow network round trips (e.g. token validation).
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            # move to the most-recently-used end
+            del self._data[key]
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        # membership checks do not count towards hits/misses
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > time.time()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses}
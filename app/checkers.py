@@ -2,87 +2,116 @@
 CheckRequest class and subclasses
 
 These are for validating PUT and POST request bodies.
+Each checker compiles its field rules once; a body is then checked in a single
+pass over its keys, and lists of bodies can be checked in bulk.
 """
 
+STRING = (str, unicode)
+
+
+def valid_labels(labels):
+    # label values are strings, or lists of strings such as tags
+    return all(isinstance(k, STRING) and (isinstance(v, STRING) or
+                                          (type(v) == list and all(isinstance(x, STRING) for x in v)))
+               for k, v in labels.iteritems())
+
+
 class CheckRequest:
 
+    key_types = {"name": STRING,
+                 "ip": STRING,
+                 "project": STRING,
+                 "in_use": bool,
+                 "private": bool,
+                 "usable": bool,
+                 "labels": dict}
+    required_keys = ["name", "ip", "project", "in_use"]
+    immutable_keys = ["name", "project"]
+
     def __init__(self):
-        self.required_keys = ["name", "ip", "project", "in_use"]
-        self.key_types = {"name": self.type_check([str, unicode]),
-                          "ip": self.type_check([str, unicode]),
-                          "project": self.type_check([str, unicode]),
-                          "in_use": self.type_check(bool),
-                          "private": self.type_check(bool),
-                          "usable": self.type_check(bool)}
-        self.immutable_keys = ["name", "project"]
-
-    # takes a single type or a list of types
-    def type_check(self, types):
-        if type(types) == list:
-            return reduce(lambda x,y: x or y, [lambda x: type(x) == y for y in types])
-        return lambda x: type(x) == types
+        # key -> exact types it accepts (so True is not taken for an int, nor 1 for a bool)
+        self._types = dict((k, frozenset(t if isinstance(t, tuple) else (t,))) for k, t in self.key_types.items())
+        self._immutable = frozenset(self.immutable_keys)
 
     def if_can_update_attr(self, request_dict, resource):
         if "in_use" in request_dict:
             return resource.get("usable")
         return True
 
-    def concat_errors(self, error_dict):
-        return reduce(lambda x,y: ' ; '.join([x,y]), [k for k,v in error_dict.iteritems() if not v], "")
-
-    def check_request_contains(self, request_dict, keys):
-        return [k for k in keys if k not in request_dict.keys()]
-
-    def check_request_does_not_contain(self, request_dict, keys):
-        return [k for k in keys if k in request_dict.keys()]
-
-    def check_request_types(self, request_dict, key_types):
-        return [k for k, v in request_dict.iteritems() if k in key_types.keys() and not key_types[k](v)]
-
-    def check_request_create(self, request_dict, required_keys=None, key_types=None):
-        required_keys = required_keys or self.required_keys
-        key_types = key_types or self.key_types
-        missing = self.check_request_contains(request_dict, required_keys)
-        bad_types = self.check_request_types(request_dict, key_types)
-
-        errors = {"Request missing following fields: {}".format(str(missing)): len(missing) == 0,
-                  "The following fields are incorrectly typed {}".format(str(bad_types)): len(bad_types) == 0}
-        return self.concat_errors(errors)
-
-    def check_request_update(self, request_dict, immutable_keys=None, key_types=None):
-        immutable_keys = immutable_keys or self.immutable_keys
-        key_types = key_types or self.key_types
-        bad_fields = self.check_request_does_not_contain(request_dict, immutable_keys)
-        bad_types = self.check_request_types(request_dict, key_types)
-
-        errors = {"The following fields cannot be updated: {}".format(str(bad_fields)): len(bad_fields) == 0,
-                  "The following fields are incorrectly typed {}".format(str(bad_types)): len(bad_types) == 0}
-
-        return self.concat_errors(errors)
+    def bad_types(self, request_dict):
+        types = self._types
+        bad = [k for k, v in request_dict.iteritems() if k in types and type(v) not in types[k]]
+        if "labels" in request_dict and "labels" not in bad and not valid_labels(request_dict["labels"]):
+            bad.append("labels")
+        return bad
+
+    def concat_errors(self, errors):
+        return ' ; '.join(message.format(str(keys)) for message, keys in errors if keys)
+
+    def check_request_create(self, request_dict):
+        if not isinstance(request_dict, dict):
+            return "Request body must be a JSON object"
+        missing = [k for k in self.required_keys if k not in request_dict]
+        return self.concat_errors([("Request missing following fields: {}", missing),
+                                   ("The following fields are incorrectly typed {}", self.bad_types(request_dict))])
+
+    def check_request_update(self, request_dict):
+        if not isinstance(request_dict, dict):
+            return "Request body must be a JSON object"
+        bad_fields = [k for k in request_dict if k in self._immutable]
+        return self.concat_errors([("The following fields cannot be updated: {}", bad_fields),
+                                   ("The following fields are incorrectly typed {}", self.bad_types(request_dict))])
+
+    def check_requests_create(self, request_dicts):
+        """Checks many create bodies at once. Returns {index: errors} for the bodies that failed."""
+        return self._check_all(self.check_request_create, request_dicts)
+
+    def check_requests_update(self, request_dicts):
+        """Checks many update bodies at once. Returns {index: errors} for the bodies that failed."""
+        return self._check_all(self.check_request_update, request_dicts)
+
+    def check_request_batch(self, items):
+        """Checks the items of a /resources/batch request. Returns {index: errors} for the items that failed."""
+        errors = {}
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or item.get("op") not in ("create", "update", "delete"):
+                errors[i] = "Each item must be an object with an op of create, update or delete"
+            elif item["op"] == "create":
+                e = self.check_request_create(item.get("body"))
+                if e:
+                    errors[i] = e
+            elif not isinstance(item.get("name"), STRING) or not isinstance(item.get("project"), STRING + (type(None),)):
+                errors[i] = "{0} items need a resource name (and optionally a project)".format(item["op"])
+            elif item["op"] == "update":
+                e = self.check_request_update(item.get("body"))
+                if e:
+                    errors[i] = e
+        return errors
+
+    def _check_all(self, check, request_dicts):
+        errors = {}
+        for i, request_dict in enumerate(request_dicts):
+            e = check(request_dict)
+            if e:
+                errors[i] = e
+        return errors
 
 
 class CheckRequestGcloud(CheckRequest):
 
-    def __init__(self):
-        CheckRequest.__init__(self)
-        self.key_types = {"name": CheckRequest.type_check(self, [str, unicode]),
-                          "project": CheckRequest.type_check(self, [str, unicode]),
-                          "zone": CheckRequest.type_check(self, [str, unicode]),
-                          "in_use": CheckRequest.type_check(self, bool),
-                          "ip": CheckRequest.type_check(self, [str, unicode]),
-                          "private": CheckRequest.type_check(self, bool),
-                          "tags": CheckRequest.type_check(self, list),
-                          "disk_size": CheckRequest.type_check(self, [str, unicode]),
-                          "disk_type": CheckRequest.type_check(self, [str, unicode]),
-                          "machine_type": CheckRequest.type_check(self, [str, unicode]),
-                          "usable": CheckRequest.type_check(self, bool)}
-        self.required_keys = ["name", "tags", "project", "zone", "in_use"]
-
-    def check_request_create(self, request_dict, required_keys=None, key_types=None):
-        return CheckRequest.check_request_create(self, request_dict, required_keys=self.required_keys, key_types=self.key_types)
-
-    def check_request_update(self, request_dict, immutable_keys=None, key_types=None):
-        return CheckRequest.check_request_update(self, request_dict, key_types=self.key_types)
+    key_types = {"name": STRING,
+                 "project": STRING,
+                 "zone": STRING,
+                 "in_use": bool,
+                 "ip": STRING,
+                 "private": bool,
+                 "tags": list,
+                 "disk_size": STRING,
+                 "disk_type": STRING,
+                 "machine_type": STRING,
+                 "usable": bool,
+                 "labels": dict}
+    required_keys = ["name", "tags", "project", "zone", "in_use"]
 
 
 def generate_request_checker(backend):
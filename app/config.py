@@ -1,5 +1,12 @@
 import sys, os
-from backends.gcloud import create_compute_instance_from_json_creds, is_compute_editor
+import glob
+import tempfile
+from backends.gcloud import get_service_acct_creds, create_compute_instance, is_compute_editor, list_all_instances
+from cache import TTLCache
+from poller import OperationPoller
+from images import ImageResolver
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import dotenv
 
 # Flask config.py
@@ -11,6 +18,55 @@ class Config():
     RESOURCE_TYPE = os.environ.get('RESOURCE_TYPE') or 'default'
     OAUTH_PROJECT = os.environ.get('OAUTH_PROJECT') or None
     ROOT_DIR = os.environ.get("ROOT_DIR") or "/app"
+    # 'userinfo' validates every new token with Google; 'idtoken' verifies JWT ID tokens locally
+    AUTH_MODE = os.environ.get('AUTH_MODE') or 'userinfo'
+    ID_TOKEN_AUDIENCE = os.environ.get('ID_TOKEN_AUDIENCE') or None
+    ID_TOKEN_CERTS_URL = os.environ.get('ID_TOKEN_CERTS_URL') or None
+    # validated tokens are cached by hash; rejected tokens are cached for a shorter time
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 1024)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+    TOKEN_CACHE_NEGATIVE_TTL = int(os.environ.get('TOKEN_CACHE_NEGATIVE_TTL') or 30)
+    # compute editor decisions per (user, OAUTH_PROJECT)
+    AUTHZ_CACHE_SIZE = int(os.environ.get('AUTHZ_CACHE_SIZE') or 1024)
+    AUTHZ_CACHE_TTL = int(os.environ.get('AUTHZ_CACHE_TTL') or 600)
+    AUTH_WORKERS = int(os.environ.get('AUTH_WORKERS') or 8)
+    # comma separated emails allowed to clear other users' cached decisions with DELETE /auth/cache
+    AUTH_ADMINS = [u.strip() for u in (os.environ.get('AUTH_ADMINS') or '').split(',') if u.strip()]
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE') or 1000)
+    # milliseconds a /resources/name/<keyword>?mode=regex search may run before it is cancelled
+    SEARCH_REGEX_TIMEOUT = int(os.environ.get('SEARCH_REGEX_TIMEOUT') or 2000)
+    MAX_BATCH_ALLOCATE = int(os.environ.get('MAX_BATCH_ALLOCATE') or 100)
+    # allocate?wait=<seconds> holds a request until a resource is released
+    MAX_ALLOCATE_WAIT = int(os.environ.get('MAX_ALLOCATE_WAIT') or 300)
+    ALLOCATE_POLL_INTERVAL = int(os.environ.get('ALLOCATE_POLL_INTERVAL') or 5)
+    # allocations may hold a lease that is kept with heartbeats; LEASE_TTL is the default (0 = no lease)
+    # and expired leases are freed every LEASE_SWEEP_INTERVAL seconds
+    LEASE_TTL = int(os.environ.get('LEASE_TTL') or 0)
+    MAX_LEASE_TTL = int(os.environ.get('MAX_LEASE_TTL') or 86400)
+    LEASE_SWEEP_INTERVAL = int(os.environ.get('LEASE_SWEEP_INTERVAL') or 30)
+    # with a positive interval, google and the db are reconciled in bulk and requests trust the db;
+    # set RECONCILE_IN_PROCESS=false when running `manage.py reconcile --loop` separately
+    RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL') or 0)
+    RECONCILE_IN_PROCESS = (os.environ.get('RECONCILE_IN_PROCESS') or 'true').lower() == 'true'
+    # keep this many free, usable resources per project (a project's .env may set its own WARM_POOL_SIZE);
+    # surplus ones are stopped after WARM_POOL_COOLDOWN seconds. WARM_POOL_CREATE allows new instances too
+    WARM_POOL_SIZE = int(os.environ.get('WARM_POOL_SIZE') or 0)
+    WARM_POOL_INTERVAL = int(os.environ.get('WARM_POOL_INTERVAL') or 60)
+    WARM_POOL_COOLDOWN = int(os.environ.get('WARM_POOL_COOLDOWN') or 900)
+    WARM_POOL_CREATE = (os.environ.get('WARM_POOL_CREATE') or 'false').lower() == 'true'
+    WARM_POOL_NAME_PREFIX = os.environ.get('WARM_POOL_NAME_PREFIX') or 'warm'
+    WARM_POOL_TAGS = [t for t in (os.environ.get('WARM_POOL_TAGS') or '').split(',') if t]
+    WARM_POOL_IN_PROCESS = (os.environ.get('WARM_POOL_IN_PROCESS') or 'true').lower() == 'true'
+    # ?async=true runs create/update/delete on this many workers and returns 202 with an operation
+    OPERATION_WORKERS = int(os.environ.get('OPERATION_WORKERS') or 4)
+    OPERATION_RETENTION = int(os.environ.get('OPERATION_RETENTION') or 3600)
+    MAX_OPERATION_WAIT = int(os.environ.get('MAX_OPERATION_WAIT') or 60)
+    # items accepted by one /resources/batch request, all applied in a single transaction
+    MAX_BATCH_CHANGES = int(os.environ.get('MAX_BATCH_CHANGES') or 5000)
+    # names accepted by one /resources/bulk/<action> request; google calls are batched 1000 at a time
+    MAX_BULK_ACTION = int(os.environ.get('MAX_BULK_ACTION') or 1000)
+    # serve Prometheus metrics at /metrics (unauthenticated, like /); each process keeps its own
+    METRICS_ENABLED = (os.environ.get('METRICS_ENABLED') or 'true').lower() == 'true'
     ALL_FIELDS = ["name", "ip", "project", "in_use", "private"]
     REQUIRED_FIELDS = ["name", "ip", "project", "in_use"]
     SWAGGER = {"title": "jacalloc",
@@ -21,16 +77,59 @@ class Config():
 
 
 class GcloudConfig(Config):
+    # seconds a project's instance list is trusted before listing it again
+    INVENTORY_TTL = int(os.environ.get('INVENTORY_TTL') or 30)
+    # threads used to look an instance up in several projects at once
+    LOOKUP_WORKERS = int(os.environ.get('LOOKUP_WORKERS') or 8)
+    # one <project>.env per gcloud project; see README
+    PROJECTS_DIR = os.environ.get('PROJECTS_DIR') or os.getcwd()
+    # each project shares one compute client across threads, with at most this many requests in flight
+    COMPUTE_CONNECTIONS = int(os.environ.get('COMPUTE_CONNECTIONS') or 8)
+    # the compute discovery document is kept here so workers start without fetching it
+    DISCOVERY_CACHE_DIR = os.environ.get('DISCOVERY_CACHE_DIR') or tempfile.gettempdir()
+    # google operations are polled together per zone, backing off between these bounds (seconds)
+    OPERATION_POLL_MIN_INTERVAL = float(os.environ.get('OPERATION_POLL_MIN_INTERVAL') or 1)
+    OPERATION_POLL_MAX_INTERVAL = float(os.environ.get('OPERATION_POLL_MAX_INTERVAL') or 10)
+    OPERATION_TIMEOUT = int(os.environ.get('OPERATION_TIMEOUT') or 600)
+    # seconds an image family's current image is reused for new instances
+    IMAGE_CACHE_TTL = int(os.environ.get('IMAGE_CACHE_TTL') or 3600)
+
     def __init__(self):
         self.projects = self.init_projects()
+        self.inventory = TTLCache(maxsize=max(len(self.projects), 1), ttl=self.INVENTORY_TTL)
+        self._inventory_lock = threading.Lock()
+        self.lookup_pool = ThreadPoolExecutor(max_workers=self.LOOKUP_WORKERS)
+        self.operation_poller = OperationPoller(self, min_interval=self.OPERATION_POLL_MIN_INTERVAL,
+                                                max_interval=self.OPERATION_POLL_MAX_INTERVAL)
+        self.images = ImageResolver(ttl=self.IMAGE_CACHE_TTL)
+
+    @property
+    def trust_db(self):
+        return self.RECONCILE_INTERVAL > 0
+
+    def instance_names(self, project):
+        """Names of all instances in a project, from one paginated list call per INVENTORY_TTL."""
+        p = self.projects.get(project)
+        if not p:
+            return frozenset()
+        names = self.inventory.get(project)
+        if names is None:
+            with self._inventory_lock:
+                names = self.inventory.get(project)
+                if names is None:
+                    names = frozenset(i['name'] for i in list_all_instances(p.compute, project, p.zone))
+                    self.inventory.set(project, names)
+        return names
 
     def init_projects(self):
+        """Registers a project for each <project>.env in PROJECTS_DIR. Only the .env files are read here;
+        credentials and compute clients are loaded the first time a project is used."""
         projects = {}
-        for _, _, files in os.walk(os.getcwd()):
-            for f in files:
-                if f.endswith(".env"):
-                    p_name = f.split(".")[0]
-                    projects[p_name] = GcloudProjConfig(p_name)
+        for path in sorted(glob.glob(os.path.join(self.PROJECTS_DIR, "*.env"))):
+            p_name = os.path.basename(path).split(".")[0]
+            projects[p_name] = GcloudProjConfig(p_name, dotenv.dotenv_values(path),
+                                                discovery_cache_dir=self.DISCOVERY_CACHE_DIR,
+                                                connections=self.COMPUTE_CONNECTIONS)
         return projects
 
     def is_authorized(self, *args, **kwargs):
@@ -38,13 +137,38 @@ class GcloudConfig(Config):
 
 
 class GcloudProjConfig():
-    def __init__(self, project_name):
+    def __init__(self, project_name, env, discovery_cache_dir=None, connections=8):
         print "creating config for project {}".format(project_name)
-        clear_env()
-        dotenv.load_dotenv(dotenv.find_dotenv(project_name + ".env"))
-        self.compute = create_compute_instance_from_json_creds(os.getenv("SVC_ACCT_PATH"))
-        self.zone = os.getenv("ZONE")
+        self.svc_acct_path = env.get("SVC_ACCT_PATH")
+        self.zone = env.get("ZONE")
+        self.image_project = env.get("IMAGE_PROJECT") or "ubuntu-os-cloud"
+        self.image_family = env.get("IMAGE_FAMILY") or "ubuntu-1604-lts"
+        self.warm_pool_size = int(env["WARM_POOL_SIZE"]) if env.get("WARM_POOL_SIZE") else None
         self.project = project_name
+        self.discovery_cache_dir = discovery_cache_dir
+        self.connections = connections
+        self._credentials = None
+        self._compute = None
+        self._lock = threading.Lock()
+
+    @property
+    def credentials(self):
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials = get_service_acct_creds(self.svc_acct_path)
+        return self._credentials
+
+    @property
+    def compute(self):
+        # built once and shared by every thread; its requests borrow from a pool of `connections`
+        if self._compute is None:
+            credentials = self.credentials
+            with self._lock:
+                if self._compute is None:
+                    self._compute = create_compute_instance(credentials, self.discovery_cache_dir,
+                                                            connections=self.connections)
+        return self._compute
 
 
 def generate_config(resource_backend):
@@ -54,10 +178,3 @@ def generate_config(resource_backend):
         print "[WARN] No resource backend specified, using default config."
         return None
 
-
-def clear_env():
-    keys = ["SVC_ACCT_PATH", "ZONE"]
-    for k in keys:
-        if k in os.environ:
-            del os.environ[k]
-
@@ -0,0 +1,169 @@
+"""
+Local verification of Google-issued ID tokens
+
+Tokens are checked against signing keys fetched from a KeySource and cached
+for as long as the source allows, so verifying a token needs no network call.
+A key source has an `is_x509_cert` flag and a fetch() returning (keys, max_age),
+where keys maps key id -> PEM string. GoogleCertsKeySource reads Google's published
+certificates, StaticKeySource serves a fixed key set (e.g. a fake issuer in tests).
+"""
+import base64
+import json
+import numbers
+import re
+import threading
+import time
+import requests
+from oauth2client import crypt
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+
+def parse_max_age(cache_control, default):
+    match = re.search(r"max-age=(\d+)", cache_control or "")
+    return int(match.group(1)) if match else default
+
+
+def is_jwt(token):
+    return token.count(".") == 2
+
+
+def _b64decode(segment):
+    segment = segment.encode("ascii")
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+class GoogleCertsKeySource:
+    is_x509_cert = True
+
+    def __init__(self, url=GOOGLE_CERTS_URL, default_max_age=3600):
+        self.url = url
+        self.default_max_age = default_max_age
+
+    def fetch(self):
+        resp = requests.get(self.url, timeout=10)
+        resp.raise_for_status()
+        return resp.json(), parse_max_age(resp.headers.get("Cache-Control"), self.default_max_age)
+
+
+class StaticKeySource:
+
+    def __init__(self, keys, is_x509_cert=False, max_age=3600):
+        self.keys = keys
+        self.is_x509_cert = is_x509_cert
+        self.max_age = max_age
+
+    def fetch(self):
+        return dict(self.keys), self.max_age
+
+
+class IdTokenVerifier:
+
+    def __init__(self, key_source, audience, issuers=GOOGLE_ISSUERS, clock_skew=300,
+                 refresh_margin=60, min_refresh_interval=30):
+        self.key_source = key_source
+        self.audience = audience
+        self.issuers = issuers
+        self.clock_skew = clock_skew
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self._verifiers = {}
+        self._expires = 0
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def refresh(self):
+        keys, max_age = self.key_source.fetch()
+        verifiers = dict((kid, crypt.Verifier.from_string(pem, self.key_source.is_x509_cert))
+                         for kid, pem in keys.items())
+        with self._lock:
+            self._verifiers = verifiers
+            self._expires = time.time() + max_age
+            self._last_refresh = time.time()
+
+    def start(self):
+        """Keeps the key set fresh from a background thread."""
+        if self._refresher:
+            return
+        self._refresher = threading.Thread(target=self._refresh_loop, name="idtoken-keys")
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+                delay = max(self._expires - time.time() - self.refresh_margin, self.min_refresh_interval)
+            except Exception as e:
+                print "[WARN] Unable to refresh ID token signing keys: {0}".format(e)
+                delay = self.min_refresh_interval
+            time.sleep(delay)
+
+    def _get_verifiers(self, kid):
+        now = time.time()
+        stale = now >= self._expires or (kid and kid not in self._verifiers)
+        # an unknown key id may mean the issuer rotated keys; refetch, but not on every bad token
+        if stale and now - self._last_refresh >= self.min_refresh_interval:
+            try:
+                self.refresh()
+            except Exception as e:
+                self._last_refresh = now
+                print "[WARN] Unable to refresh ID token signing keys: {0}".format(e)
+        if kid:
+            return [self._verifiers[kid]] if kid in self._verifiers else []
+        return self._verifiers.values()
+
+    def verify(self, token):
+        """Returns the verified claims of an ID token, or None if it is invalid."""
+        if token.startswith("Bearer "):
+            token = token[len("Bearer "):]
+        if not is_jwt(token):
+            return None
+        header_seg, payload_seg, signature_seg = token.split(".")
+        try:
+            header = json.loads(_b64decode(header_seg))
+            payload = json.loads(_b64decode(payload_seg))
+            signature = _b64decode(signature_seg)
+        except (ValueError, TypeError, UnicodeError):
+            return None
+        if not isinstance(header, dict) or not isinstance(payload, dict):
+            return None
+
+        message = (header_seg + "." + payload_seg).encode("ascii")
+        if not any(v.verify(message, signature) for v in self._get_verifiers(header.get("kid"))):
+            return None
+
+        now = time.time()
+        exp, iat = payload.get("exp"), payload.get("iat", 0)
+        if not isinstance(exp, numbers.Number) or not isinstance(iat, numbers.Number):
+            return None
+        if payload.get("iss") not in self.issuers:
+            return None
+        if payload.get("aud") != self.audience:
+            return None
+        if exp + self.clock_skew < now or iat - self.clock_skew > now:
+            return None
+        return payload
+
+    def validate_token(self, token):
+        """Drop-in replacement for backends.gcloud.validate_token.
+
+        Returns None on fail, and an e-mail on success"""
+        claims = self.verify(token)
+        if not claims or claims.get("email_verified") is False:
+            return None
+        return claims.get("email")
+
+
+def generate_id_token_verifier(auth_mode, audience=None, certs_url=None):
+    if auth_mode == 'idtoken':
+        if not audience:
+            # without an audience, an ID token minted for any google client would be accepted
+            raise ValueError("AUTH_MODE=idtoken requires ID_TOKEN_AUDIENCE to be set")
+        verifier = IdTokenVerifier(GoogleCertsKeySource(certs_url or GOOGLE_CERTS_URL), audience=audience)
+        verifier.start()
+        return verifier
+    else:
+        return None
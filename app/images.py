@@ -0,0 +1,54 @@
+"""
+ImageResolver class
+
+Resolves image families (e.g. ubuntu-os-cloud/ubuntu-1604-lts) to the selfLink of
+their current image once per TTL, shared by every project, so creating an
+instance does not need a getFromFamily round trip first. Families that have been
+resolved are refreshed from a background thread before they expire.
+"""
+import threading
+import time
+from cache import TTLCache
+from backends.gcloud import get_image_from_family
+
+
+class ImageResolver:
+
+    def __init__(self, ttl=3600, maxsize=64):
+        self.ttl = ttl
+        self._images = TTLCache(maxsize=maxsize, ttl=ttl)
+        # (image project, family) -> a project config whose credentials can read it
+        self._families = {}
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def resolve(self, project_attrs):
+        """Returns the source image selfLink for a project's IMAGE_PROJECT/IMAGE_FAMILY."""
+        key = (project_attrs.image_project, project_attrs.image_family)
+        image = self._images.get(key)
+        if image is None:
+            image = self._fetch(key, project_attrs)
+            with self._lock:
+                self._families.setdefault(key, project_attrs)
+                if not self._refresher:
+                    self._refresher = threading.Thread(target=self._refresh_loop, name="image-refresh")
+                    self._refresher.daemon = True
+                    self._refresher.start()
+        return image
+
+    def _fetch(self, key, project_attrs):
+        image = get_image_from_family(project_attrs.compute, key[0], key[1])['selfLink']
+        self._images.set(key, image)
+        return image
+
+    def _refresh_loop(self):
+        while True:
+            # refresh at half the ttl so a failed refresh still leaves the old image in place
+            time.sleep(self.ttl / 2.0)
+            with self._lock:
+                families = self._families.items()
+            for key, project_attrs in families:
+                try:
+                    self._fetch(key, project_attrs)
+                except Exception as e:
+                    print "[WARN] Unable to refresh image family {0}/{1}: {2}".format(key[0], key[1], e)
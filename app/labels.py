@@ -0,0 +1,61 @@
+"""
+Label selectors
+
+Parses selectors like `machine_type=n1-standard-8,tags in (gpu,ssd),!retired`
+and turns them into SQL over the resources' JSONB labels. Every requirement is
+a containment (@>) or key (?) test, so Postgres answers them from the GIN index.
+A label may hold a string or a list of strings (e.g. tags); `key=value`
+matches either the string or a list that contains it.
+"""
+import re
+from sqlalchemy import type_coerce, or_, and_, not_
+from sqlalchemy.dialects.postgresql import JSONB
+from models import Resource
+
+_KEY = r"[A-Za-z0-9_./-]+"
+_REQUIREMENT = re.compile(r"""\s*(?:
+    !\s*(?P<absent>{key}) |
+    (?P<key>{key})(?:
+        \s*(?P<op>==|=|!=)\s*(?P<value>[^,()\s]+) |
+        \s+(?P<setop>in|notin)\s*\((?P<values>[^()]*)\)
+    )?
+)\s*(?:,|$)""".format(key=_KEY), re.X)
+
+
+def parse_selector(selector):
+    """Parses a label selector into a list of (key, op, values) requirements, where op is
+    one of 'in', 'notin', 'exists' or 'absent'. Raises ValueError if it is malformed."""
+    if not selector or not selector.strip():
+        return []
+    requirements = []
+    pos = 0
+    while pos < len(selector):
+        m = _REQUIREMENT.match(selector, pos)
+        if not m or m.end() == pos:
+            raise ValueError("Invalid label selector at \"{0}\"".format(selector[pos:]))
+        pos = m.end()
+        if m.group('absent'):
+            requirements.append((m.group('absent'), 'absent', []))
+        elif m.group('op'):
+            requirements.append((m.group('key'), 'notin' if m.group('op') == '!=' else 'in', [m.group('value')]))
+        elif m.group('setop'):
+            values = [v.strip() for v in m.group('values').split(',') if v.strip()]
+            if not values:
+                raise ValueError("Empty value list for label {0}".format(m.group('key')))
+            requirements.append((m.group('key'), m.group('setop'), values))
+        else:
+            requirements.append((m.group('key'), 'exists', []))
+    return requirements
+
+
+def selector_clause(requirements):
+    """SQL that a resource's labels must satisfy to match every requirement."""
+    labels = type_coerce(Resource.labels, JSONB)
+    clauses = []
+    for key, op, values in requirements:
+        if op in ('exists', 'absent'):
+            clause = labels.has_key(key)
+        else:
+            clause = or_(*[or_(labels.contains({key: v}), labels.contains({key: [v]})) for v in values])
+        clauses.append(not_(clause) if op in ('notin', 'absent') else clause)
+    return and_(*clauses)
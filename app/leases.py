@@ -0,0 +1,56 @@
+"""
+LeaseSweeper class
+
+Frees resources whose allocation lease has expired. Holders keep a lease alive
+with heartbeats; once they stop, a pass of the sweeper returns every expired
+resource to the pool with a single update.
+"""
+import threading
+import time
+import datetime
+from models import db
+
+
+class LeaseSweeper:
+
+    def __init__(self, app, resource_methods, interval=30):
+        self.app = app
+        self.resource_methods = resource_methods
+        self.interval = interval
+        self.stats = {"runs": 0, "expired": 0, "errors": 0, "last_run": None}
+        self._thread = None
+
+    def start(self):
+        """Sweeps every `interval` seconds from a background thread."""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self.run_forever, name="lease-sweeper")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run_forever(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                self.run_once()
+
+    def run_once(self):
+        try:
+            expired = self.resource_methods.expire_leases()
+            self.stats["expired"] += expired
+            if expired:
+                print "[INFO] Freed {0} resources with expired leases".format(expired)
+        except Exception as e:
+            db.session.rollback()
+            self.stats["errors"] += 1
+            print "[WARN] Unable to sweep expired leases: {0}".format(e)
+        self.stats["runs"] += 1
+        self.stats["last_run"] = datetime.datetime.now().isoformat()
+        return self.stats
+
+
+def generate_lease_sweeper(app, resource_methods, interval):
+    if interval > 0:
+        return LeaseSweeper(app, resource_methods, interval=interval)
+    else:
+        return None
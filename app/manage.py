@@ -1,6 +1,8 @@
 from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
-from app import app, db
+from app import app, db, backend_config, resource_methods
+from reconciler import Reconciler
+from pool import generate_warm_pool
 
 
 manager = Manager(app)
@@ -8,5 +10,32 @@ migrate = Migrate(app, db)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def reconcile(loop=False):
+    """Syncs the resources table with google. With --loop, repeats every RECONCILE_INTERVAL seconds."""
+    if app.config['RESOURCE_BACKEND'] != 'gce':
+        print "Nothing to reconcile for the {0} backend.".format(app.config['RESOURCE_BACKEND'])
+        return
+    reconciler = Reconciler(app, backend_config, interval=app.config['RECONCILE_INTERVAL'] or 60)
+    if loop:
+        reconciler.run_forever()
+    else:
+        print reconciler.run_once()
+
+
+@manager.command
+def warm(loop=False):
+    """Tops up the warm pool once. With --loop, repeats every WARM_POOL_INTERVAL seconds."""
+    pool = generate_warm_pool(app.config['RESOURCE_BACKEND'], app, resource_methods, backend_config, app.config)
+    if not pool:
+        print "No warm pool is configured for the {0} backend.".format(app.config['RESOURCE_BACKEND'])
+        return
+    if loop:
+        pool.run_forever()
+    else:
+        print pool.run_once()
+
+
 if __name__ == '__main__':
     manager.run()
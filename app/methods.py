@@ -1,8 +1,63 @@
-from models import db, Resource
+from models import db, Resource, FIELDS, field_columns, project_row
 from backends.gcloud import *
-import random
+from waiters import RELEASE_CHANNEL
+from labels import selector_clause
+import base64
 import datetime
+import time
+import uuid
+from sqlalchemy import text, func, case, and_, or_
 from googleapiclient.errors import HttpError
+from concurrent.futures import as_completed
+
+
+def encode_cursor(resource_id):
+    return base64.urlsafe_b64encode(str(resource_id))
+
+
+def decode_cursor(cursor):
+    """Returns the resource id a page cursor points after; raises ValueError if it is malformed."""
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError):
+        raise ValueError("Invalid cursor {0}".format(cursor))
+
+
+def iter_rows(query, fields=None):
+    """Yields (id, resource dict) pairs for a resource query, streaming from a server-side cursor.
+    With `fields`, only the columns behind them are selected and no ORM objects are built."""
+    if fields:
+        rows = query.with_entities(*field_columns(fields))
+        for x in rows.execution_options(stream_results=True).yield_per(500):
+            yield x.id, project_row(x, fields)
+    else:
+        for x in query.execution_options(stream_results=True).yield_per(500):
+            yield x.id, x.map()
+
+
+def escape_like(keyword):
+    """Escapes LIKE wildcards so a keyword only matches itself (postgres escapes with a backslash)."""
+    return keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def release_changes():
+    # what every release writes: the resource is free, holds no lease and is no longer timed as running
+    return {'in_use': False, 'lease_id': None, 'lease_expires': None, 'timestamp': None,
+            'released_at': datetime.datetime.now()}
+
+
+def notify_released(project=None):
+    """Tells waiting allocators that a resource became free.
+    Postgres delivers the notification when the current transaction commits."""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify(:channel, :project)"),
+                           {"channel": RELEASE_CHANNEL, "project": project or ''})
+
+
+SEARCH_MODES = ("substring", "prefix", "regex")
+
+# columns a batch update may set; name and project are rejected by the request checker
+UPDATABLE_COLUMNS = frozenset(["ip", "in_use", "private", "usable", "labels"])
 
 
 class ResourceMethods:
@@ -15,18 +70,56 @@ class ResourceMethods:
             return Resource.query.filter(Resource.project == project).filter(Resource.name == name).first()
         return Resource.query.filter(Resource.name == name).first()
 
-    def list_resources_by_keyword(self, keyword):
-        return Resource.query.filter(Resource.name.op("~")(keyword))
-
-    def get_all_resources(self, **filters):
+    def list_resources_by_keyword(self, keyword, mode="substring", regex_timeout=None):
+        """Resources whose name contains (substring), starts with (prefix) or matches (regex) `keyword`.
+        Substring and prefix searches are LIKE patterns served by the trigram and pattern indexes.
+        A regex search runs under a `regex_timeout` (ms) statement timeout on postgres."""
+        if mode == "regex":
+            if regex_timeout and db.engine.dialect.name == 'postgresql':
+                # only lasts until the end of this request's transaction
+                db.session.execute(text("SET LOCAL statement_timeout = {0:d}".format(int(regex_timeout))))
+            return Resource.query.filter(Resource.name.op("~")(keyword))
+        pattern = escape_like(keyword) + "%"
+        if mode == "substring":
+            pattern = "%" + pattern
+        return Resource.query.filter(Resource.name.like(pattern))
+
+    def search_resources(self, keyword, mode="substring", after=None, limit=None, fields=None, regex_timeout=None):
+        """Yields (id, resource dict) pairs of a keyword search in id order, starting after the id `after`."""
+        res = self.list_resources_by_keyword(keyword, mode, regex_timeout).order_by(Resource.id)
+        if after:
+            res = res.filter(Resource.id > after)
+        if limit:
+            res = res.limit(limit)
+        return iter_rows(res, fields)
+
+    def query_resources(self, **filters):
+        expiry = filters.pop('expired', None) if 'expired' in filters else False
+        selector = filters.pop('selector', None)
         res = Resource.query
+        if selector:
+            res = res.filter(selector_clause(selector))
         for name, filt in filters.iteritems():
-            if filt is not None and name is not 'expired':
+            if filt is not None:
                 d = {name: filt}
                 res = res.filter_by(**d)
-        if 'expired' in filters:
-            return [x.map() for x in res.all() if x.is_expired(filters['expired'] or 18000)]
-        return [x.map() for x in res.all()]
+        if expiry is not False:
+            # same clock as the timestamps written on allocation, so only expired rows are fetched
+            cutoff = datetime.datetime.now() - datetime.timedelta(seconds=expiry or 18000)
+            res = res.filter(Resource.timestamp <= cutoff)
+        return res
+
+    def iter_resources(self, after=None, limit=None, fields=None, **filters):
+        """Yields (id, resource dict) pairs in id order, starting after the id `after`."""
+        res = self.query_resources(**filters).order_by(Resource.id)
+        if after:
+            res = res.filter(Resource.id > after)
+        if limit:
+            res = res.limit(limit)
+        return iter_rows(res, fields)
+
+    def get_all_resources(self, **filters):
+        return [r for _, r in self.iter_resources(**filters)]
 
     def create_resource(self, body):
         resource = Resource(
@@ -35,29 +128,245 @@ class ResourceMethods:
             in_use=body.get('in_use') or False,
             project=body['project'],
             private=body.get('private') or False,
-            usable=body.get('usable') or False
+            usable=body.get('usable') or False,
+            labels=body.get('labels')
         )
         db.session.add(resource)
+        if resource.is_free():
+            notify_released(resource.project)
         db.session.commit()
 
     def update_resource(self, name, body):
         if body.get('in_use'):
             body['timestamp'] = datetime.datetime.now()
+        elif body.get('in_use') == False:
+            # a manual release ends any lease on the resource
+            body.update(release_changes())
 
         r = self.get_resource_by_name(name=name)
         for f in body.keys():
             if hasattr(r, f):
                 setattr(r, f, body[f])
 
+        if r.is_free():
+            notify_released(r.project)
         db.session.commit()
 
     def delete_resource(self, name):
         Resource.query.filter(Resource.name == name).delete()
         db.session.commit()
 
-    def pick_random_resource(self, resources):
-        x = random.randint(0, len(resources) - 1)
-        return resources[x]
+    def bulk_action(self, action, names, project=None):
+        """Applies 'start', 'stop' or 'delete' to many resources at once.
+        Returns {name: None on success, or an error message}."""
+        found = self.find_resources(names, project)
+        results = dict((n, "Resource not found") for n in names if n not in found)
+        results.update(self.apply_bulk_action(action, found, project))
+        return results
+
+    def find_resources(self, names, project=None):
+        query = db.session.query(Resource.name, Resource.project).filter(Resource.name.in_(names))
+        if project:
+            query = query.filter(Resource.project == project)
+        found = {}
+        for name, p in query:
+            found.setdefault(name, []).append(p)
+        return found
+
+    def apply_bulk_action(self, action, found, project=None, ips=None):
+        """Records a bulk action in the db for the resources in `found` ({name: [projects]})."""
+        names = list(found)
+        for i in range(0, len(names), 500):
+            query = Resource.query.filter(Resource.name.in_(names[i:i + 500]))
+            if project:
+                query = query.filter(Resource.project == project)
+            if action == 'delete':
+                query.delete(synchronize_session=False)
+            else:
+                query.update({'usable': action == 'start'}, synchronize_session=False)
+        if ips:
+            rows = db.session.query(Resource.id, Resource.name).filter(Resource.name.in_(list(ips)))
+            if project:
+                rows = rows.filter(Resource.project == project)
+            db.session.bulk_update_mappings(Resource, [{"id": r.id, "ip": ips[r.name]} for r in rows])
+        if action == 'start' and names:
+            notify_released(project)
+        db.session.commit()
+        return dict((n, None) for n in names)
+
+    def apply_batch(self, items, can_update=None):
+        """Applies a list of validated create/update/delete items in one transaction, with bulk
+        inserts and updates. Returns (committed, results), one result per item. Nothing is written
+        unless every item can be applied. `can_update(body, row)` rejects updates the same way
+        they are rejected one at a time."""
+        names = list(set(item["body"]["name"] if item["op"] == "create" else item["name"] for item in items))
+        # (name, project) -> current state of the row, or None once it is deleted in this batch
+        state = {}
+        for i in range(0, len(names), 500):
+            rows = db.session.query(Resource.id, Resource.name, Resource.project, Resource.in_use,
+                                    Resource.usable, Resource.private).filter(Resource.name.in_(names[i:i + 500]))
+            for r in rows:
+                state[(r.name, r.project)] = {"id": r.id, "in_use": r.in_use, "usable": r.usable, "private": r.private}
+
+        inserts, updates, deletes = {}, {}, set()
+        results = []
+        now = datetime.datetime.now()
+        for item in items:
+            op = item["op"]
+            if op == "create":
+                body = item["body"]
+                key = (body["name"], body["project"])
+                result = {"op": op, "name": key[0], "project": key[1]}
+                if state.get(key):
+                    result.update(status=409, error="Resource already exists!")
+                else:
+                    row = {"name": key[0], "ip": body["ip"], "project": key[1],
+                           "in_use": body.get("in_use") or False, "private": body.get("private") or False,
+                           "usable": body.get("usable") or False, "labels": body.get("labels") or {}}
+                    if row["in_use"]:
+                        row["timestamp"] = now
+                    inserts[key] = row
+                    state[key] = row
+                    result["status"] = 201
+                results.append(result)
+                continue
+
+            keys = [k for k, v in state.items() if k[0] == item["name"] and v and
+                    (not item.get("project") or k[1] == item["project"])]
+            result = {"op": op, "name": item["name"], "project": keys[0][1] if len(keys) == 1 else item.get("project")}
+            if not keys:
+                result.update(status=404, error="Resource not found!")
+            elif len(keys) > 1:
+                result.update(status=409, error="Name is in more than one project; give a project")
+            elif op == "update" and can_update and not can_update(item["body"], state[keys[0]]):
+                result.update(status=405, error="Resource is not usable!  Cannot update.")
+            elif op == "update":
+                changes = dict((k, v) for k, v in item["body"].items() if k in UPDATABLE_COLUMNS)
+                if changes.get("in_use"):
+                    changes["timestamp"] = now
+                elif changes.get("in_use") == False:
+                    changes.update(release_changes())
+                row = state[keys[0]]
+                row.update(changes)
+                if keys[0] not in inserts:
+                    updates.setdefault(row["id"], {"id": row["id"]}).update(changes)
+                result["status"] = 200
+            else:
+                row = state[keys[0]]
+                state[keys[0]] = None
+                if inserts.pop(keys[0], None) is None:
+                    updates.pop(row["id"], None)
+                    deletes.add(row["id"])
+                result["status"] = 204
+            results.append(result)
+
+        if any("error" in r for r in results):
+            db.session.rollback()
+            return False, results
+
+        ids = list(deletes)
+        for i in range(0, len(ids), 500):
+            Resource.query.filter(Resource.id.in_(ids[i:i + 500])).delete(synchronize_session=False)
+        if updates:
+            db.session.bulk_update_mappings(Resource, updates.values())
+        if inserts:
+            db.session.bulk_insert_mappings(Resource, inserts.values())
+        if any(row and not row["in_use"] and row["usable"] and not row["private"]
+               for key, row in state.items() if key in inserts or (row and row.get("id") in updates)):
+            notify_released()
+        db.session.commit()
+        return True, results
+
+    def claim_resource(self, project=None, lease_ttl=None, selector=None):
+        """Atomically marks one free resource as in_use and returns it, or None if none are free."""
+        claimed = self.claim_resources(1, project=project, lease_ttl=lease_ttl, selector=selector)
+        return claimed[0] if claimed else None
+
+    def claim_resources(self, count, project=None, all_or_nothing=False, lease_ttl=None, selector=None,
+                        projects=None):
+        """Atomically marks up to `count` free resources as in_use in one transaction and returns them.
+        Rows are locked with SKIP LOCKED so concurrent claims never pick the same resource.
+        With all_or_nothing, nothing is claimed unless `count` resources are free.
+        With a lease_ttl (seconds), the resources share one lease that must be renewed to keep them.
+        With a label selector (parsed requirements), only matching resources are claimed.
+        With a list of `projects`, only resources in those projects are claimed."""
+        query = Resource.query.filter_by(in_use=False, private=False, usable=True)
+        if project:
+            query = query.filter_by(project=project)
+        if projects is not None:
+            query = query.filter(Resource.project.in_(projects))
+        if selector:
+            query = query.filter(selector_clause(selector))
+        free = query.with_for_update(skip_locked=True).limit(count).all()
+        if not free or (all_or_nothing and len(free) < count):
+            db.session.rollback()
+            return []
+        now = datetime.datetime.now()
+        for r in free:
+            r.in_use = True
+            r.timestamp = now
+        self.start_lease(free, lease_ttl)
+        db.session.commit()
+        return free
+
+    def start_lease(self, resources, ttl):
+        """Puts claimed resources under one new lease of `ttl` seconds; the caller commits."""
+        if not ttl:
+            return
+        lease_id = uuid.uuid4().hex
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        for r in resources:
+            r.lease_id = lease_id
+            r.lease_expires = expires
+
+    def release_resources(self, ids):
+        """Frees claimed resources by id, e.g. to roll back part of a claim."""
+        if ids:
+            Resource.query.filter(Resource.id.in_(ids)).update(release_changes(), synchronize_session=False)
+            notify_released()
+        db.session.commit()
+
+    def renew_lease(self, lease_id, ttl):
+        """Extends an unexpired lease by `ttl` seconds from now. Returns the new expiry, or None if
+        the lease is unknown or has already expired."""
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        renewed = Resource.query.filter(Resource.lease_id == lease_id) \
+            .filter(Resource.lease_expires > datetime.datetime.now()) \
+            .update({'lease_expires': expires}, synchronize_session=False)
+        db.session.commit()
+        return expires if renewed else None
+
+    def release_lease(self, lease_id):
+        """Frees every resource held by a lease. Returns how many were released."""
+        released = Resource.query.filter(Resource.lease_id == lease_id).update(
+            release_changes(), synchronize_session=False)
+        if released:
+            notify_released()
+        db.session.commit()
+        return released
+
+    def expire_leases(self):
+        """Frees every resource whose lease has run out, in one statement. Returns how many were freed."""
+        expired = Resource.query.filter(Resource.lease_expires <= datetime.datetime.now()).update(
+            release_changes(), synchronize_session=False)
+        if expired:
+            notify_released()
+        db.session.commit()
+        return expired
+
+    def pool_counts(self, expiry=18000):
+        """{project: {"free": n, "in_use": n, "expired": n}} from one grouped query. Free resources are
+        the ones an allocation could claim; expired ones are in use with a lease that has run out, or
+        have been in use for longer than `expiry` seconds, as /resources/allocate/timeout reports."""
+        now = datetime.datetime.now()
+        free = and_(Resource.in_use == False, Resource.private == False, Resource.usable == True)
+        expired = and_(Resource.in_use == True, or_(Resource.lease_expires <= now,
+                                                    Resource.timestamp <= now - datetime.timedelta(seconds=expiry)))
+        rows = db.session.query(Resource.project,
+                                func.sum(case([(free, 1)], else_=0)),
+                                func.sum(case([(Resource.in_use == True, 1)], else_=0)),
+                                func.sum(case([(expired, 1)], else_=0))).group_by(Resource.project)
+        return dict((p, {"free": int(f or 0), "in_use": int(u or 0), "expired": int(e or 0)}) for p, f, u, e in rows)
 
 
 class GcloudResourceMethods(ResourceMethods):
@@ -68,21 +377,146 @@ class GcloudResourceMethods(ResourceMethods):
         self.backend_config = backend_config
 
     def get_resource_by_name(self, name, project=None):
+        if self.backend_config.trust_db:
+            # the reconciler keeps the db in line with google
+            return ResourceMethods.get_resource_by_name(self, name, project)
         if project:
             # Check within the scope of a specific project
             return GcloudInstanceResourceMethods(self.backend_config, project).get_resource_by_name(name, project)
-        else:
-            # Look within all projects; return first match found
-            x = None
-            for p in self.backend_config.projects:
-                x = GcloudInstanceResourceMethods(self.backend_config, p).get_resource_by_name(name, p)
-                if x:
-                    break
-            return x
-
-    def get_all_resources(self, **filters):
-        resources = ResourceMethods.get_all_resources(self, **filters)
-        return [r for r in resources if self.get_resource_by_name(r["name"], r["project"])]
+        # only the projects the db has this name in need asking about
+        projects = [p for (p,) in db.session.query(Resource.project).filter(Resource.name == name)
+                    if p in self.backend_config.projects]
+        if len(projects) <= 1:
+            return self.get_resource_by_name(name, projects[0]) if projects else None
+
+        # Look within those projects at once; return first match found
+        lookups = dict((self.backend_config.lookup_pool.submit(
+            GcloudInstanceResourceMethods(self.backend_config, p).instance_exists, name), p) for p in projects)
+        errors = []
+        try:
+            for f in as_completed(lookups):
+                try:
+                    found = f.result()
+                except Exception as e:
+                    # another project may still have it
+                    print "[WARN] Unable to look {0} up in project {1}: {2}".format(name, lookups[f], e)
+                    errors.append(e)
+                    continue
+                if found:
+                    return ResourceMethods.get_resource_by_name(self, name, lookups[f])
+        finally:
+            for f in lookups:
+                f.cancel()
+        if errors:
+            # no project had it, but the ones that failed might have
+            raise errors[0]
+        return None
+
+    def iter_resources(self, after=None, limit=None, fields=None, **filters):
+        if self.backend_config.trust_db:
+            return ResourceMethods.iter_resources(self, after=after, limit=limit, fields=fields, **filters)
+        lookup_fields = fields and sorted(set(fields) | {"name", "project"}, key=FIELDS.index)
+        # one instance list per project instead of one instance get per resource, fetched now so a
+        # google error fails the request rather than a response that is already being streamed
+        projects = [filters["project"]] if filters.get("project") else self.backend_config.projects.keys()
+        inventories = dict((p, self.backend_config.instance_names(p)) for p in projects)
+
+        def existing(resources):
+            return ((i, dict((f, r[f]) for f in fields) if fields else r) for i, r in resources
+                    if r["name"] in inventories.get(r["project"], ()))
+
+        if not limit:
+            return existing(ResourceMethods.iter_resources(self, after=after, fields=lookup_fields, **filters))
+        # rows gone from google are dropped after the LIMIT, so keep reading until the page is full
+        page = []
+        while len(page) < limit:
+            wanted = limit - len(page)
+            rows = list(ResourceMethods.iter_resources(self, after=after, limit=wanted, fields=lookup_fields,
+                                                       **filters))
+            page.extend(existing(rows))
+            if len(rows) < wanted:
+                break
+            after = rows[-1][0]
+        return page
+
+    def claim_resources(self, count, project=None, all_or_nothing=False, lease_ttl=None, selector=None):
+        # rows of projects without credentials can't be checked against google, so they are never offered
+        projects = list(self.backend_config.projects)
+        if not projects:
+            return []
+        if self.backend_config.trust_db:
+            return ResourceMethods.claim_resources(self, count, project=project, all_or_nothing=all_or_nothing,
+                                                   lease_ttl=lease_ttl, selector=selector, projects=projects)
+        claimed, held, rejected = [], [], []
+        while len(claimed) < count:
+            batch = ResourceMethods.claim_resources(self, count - len(claimed), project=project, selector=selector,
+                                                    projects=projects)
+            if not batch:
+                break
+            # read before the lookups, which may delete rows whose instances are gone
+            keys = [(r.id, r.name, r.project) for r in batch]
+            held += [i for i, _, _ in keys]
+            try:
+                # instances missing from the inventory snapshot are checked directly; those that are
+                # gone from google have their rows cleaned up and others are claimed in their place
+                for r, (i, name, p) in zip(batch, keys):
+                    if name in self.backend_config.instance_names(p) or self.get_resource_by_name(name, p):
+                        claimed.append(r)
+                    else:
+                        rejected.append(i)
+            except:
+                db.session.rollback()
+                self.release_resources(held)
+                raise
+        if rejected:
+            # rows whose instances are gone were deleted by the lookup; any that are left go back to the pool
+            self.release_resources(rejected)
+        if all_or_nothing and len(claimed) < count:
+            self.release_resources([r.id for r in claimed])
+            return []
+        if lease_ttl and claimed:
+            # claimed in several rounds, but held under one lease
+            self.start_lease(claimed, lease_ttl)
+            db.session.commit()
+        return claimed
+
+    def bulk_action(self, action, names, project=None):
+        found = self.find_resources(names, project)
+        results = dict((n, "Resource not found") for n in names if n not in found)
+        by_project = {}
+        for name, projects in found.items():
+            for p in projects:
+                by_project.setdefault(p, []).append(name)
+
+        # every project's batch goes out before any is waited on, so their operations run together
+        submitted = []
+        for p, project_names in by_project.items():
+            instance_methods = GcloudInstanceResourceMethods(self.backend_config, p)
+            errors, pending = instance_methods.submit_bulk_action(action, project_names)
+            results.update(errors)
+            submitted.append((instance_methods, pending))
+
+        deadline = time.time() + self.backend_config.OPERATION_TIMEOUT
+        for instance_methods, pending in submitted:
+            done = []
+            for name, future in pending.items():
+                try:
+                    if future:
+                        future.result(max(deadline - time.time(), 0))
+                    done.append(name)
+                except Exception as e:
+                    future.cancel()
+                    results[name] = "Instance {0} failed: {1}".format(action, e)
+            ips = instance_methods.instance_ips(done) if action == 'start' and done else None
+            results.update(ResourceMethods.apply_bulk_action(self, action, dict((n, [instance_methods.project]) for n in done),
+                                                             project=instance_methods.project, ips=ips))
+            if action == 'delete':
+                self.backend_config.inventory.invalidate(instance_methods.project)
+        return results
+
+    def apply_batch(self, items, can_update=None):
+        raise NotImplementedError("Batch changes only apply to the default backend; "
+                                  "use /resources/bulk/<action> for gcloud instances")
 
     def update_resource(self, name, body):
         r = self.get_resource_by_name(name)
@@ -92,6 +526,42 @@ class GcloudResourceMethods(ResourceMethods):
     def create_resource(self, body):
         GcloudInstanceResourceMethods(self.backend_config, body["project"]).create_resource(body)
 
+    def create_resources(self, bodies):
+        """Creates many instances together. Every insert is sent before any is waited on, so they boot at
+        the same time. Returns {name: None} for created resources and {name: error message} for the rest."""
+        results = {}
+        submitted = []
+        for body in bodies:
+            instance_methods = GcloudInstanceResourceMethods(self.backend_config, body["project"])
+            try:
+                if not instance_methods.project_attrs:
+                    raise StandardError("No gcloud credentials for project {0}".format(body["project"]))
+                instance_methods.label_instance(body)
+                operation = instance_methods.insert_instance(body)
+                submitted.append((instance_methods, body, self.backend_config.operation_poller.submit(
+                    instance_methods.project, instance_methods.project_attrs.zone, operation['name'])))
+            except Exception as e:
+                results[body["name"]] = str(e)
+
+        deadline = time.time() + self.backend_config.OPERATION_TIMEOUT
+        booted = {}
+        for instance_methods, body, future in submitted:
+            try:
+                future.result(max(deadline - time.time(), 0))
+                booted.setdefault(instance_methods.project, (instance_methods, []))[1].append(body)
+            except Exception as e:
+                future.cancel()
+                results[body["name"]] = "Instance create failed: {0}".format(e)
+
+        for instance_methods, project_bodies in booted.values():
+            ips = instance_methods.instance_ips([b["name"] for b in project_bodies])
+            for body in project_bodies:
+                body["ip"] = ips.get(body["name"])
+                ResourceMethods.create_resource(self, body)
+                results[body["name"]] = None
+            self.backend_config.inventory.invalidate(instance_methods.project)
+        return results
+
     def delete_resource(self, name):
         r = self.get_resource_by_name(name)
         if r:
@@ -106,21 +576,59 @@ class GcloudInstanceResourceMethods(GcloudResourceMethods):
         self.project = project
         self.project_attrs = backend_config.projects.get(project)
 
+    def instance_exists(self, name):
+        """Asks google whether the instance exists. Makes no db calls, so it can run on worker threads."""
+        try:
+            get_instance(self.project_attrs.compute, self.project, self.project_attrs.zone, name)
+            return True
+        except HttpError as e:
+            if e.resp.status == 404:
+                return False
+            raise StandardError("Something went wrong during instance get. Status: {0}".format(e.resp.status))
+
+    def wait_for_operation(self, operation):
+        return self.backend_config.operation_poller.wait(self.project, self.project_attrs.zone, operation['name'],
+                                                         timeout=self.backend_config.OPERATION_TIMEOUT)
+
+    def submit_bulk_action(self, action, names):
+        """Sends `action` for all `names` in batch requests and hands the operations to the poller.
+        Returns ({name: error message}, {name: operation future, or None if there is nothing to wait on})."""
+        if not self.project_attrs:
+            return dict((n, "No gcloud credentials for project {0}".format(self.project)) for n in names), {}
+        errors, pending = {}, {}
+        for name, (operation, e) in batch_instance_action(self.project_attrs.compute, self.project,
+                                                          self.project_attrs.zone, action, names).items():
+            if e is None:
+                pending[name] = self.backend_config.operation_poller.submit(self.project, self.project_attrs.zone,
+                                                                            operation['name'])
+            elif action == 'delete' and getattr(e, 'resp', None) and e.resp.status == 404:
+                # already gone from google; only the db row is left to remove
+                pending[name] = None
+            else:
+                errors[name] = "Instance {0} failed: {1}".format(action, e)
+        return errors, pending
+
+    def instance_ips(self, names):
+        """External ips of the named instances, from one instance listing."""
+        names = set(names)
+        ips = {}
+        for instance in list_all_instances(self.project_attrs.compute, self.project, self.project_attrs.zone):
+            if instance['name'] in names and nat_ip(instance):
+                ips[instance['name']] = nat_ip(instance)
+        return ips
+
     def get_resource_by_name(self, name, project=None):
+        if self.backend_config.trust_db:
+            return ResourceMethods.get_resource_by_name(self, name, project)
         if self.project_attrs:
-            try:
-                instance = get_instance(self.project_attrs.compute, self.project, self.project_attrs.zone, name)
+            if self.instance_exists(name):
                 return ResourceMethods.get_resource_by_name(self, name, project)
 
-            except HttpError as e:
-                if e.resp.status == 404:
-                    if ResourceMethods.get_resource_by_name(self, name, project):
-                        print "[DEBUG] Resource found in allocator db but not in google. " \
-                              "Deleting from allocator db to clean up state."
-                        ResourceMethods.delete_resource(self, name)
-                    return None
-                else:
-                    raise StandardError("Something went wrong during instance get. Status: {0}".format(e.resp.status))
+            if ResourceMethods.get_resource_by_name(self, name, project):
+                print "[DEBUG] Resource found in allocator db but not in google. " \
+                      "Deleting from allocator db to clean up state."
+                ResourceMethods.delete_resource(self, name)
+            return None
         else:
             print "[DEBUG] Cannot fetch resource; no gcloud credentials for project {0}".format(self.project)
             return None
@@ -131,7 +639,7 @@ class GcloudInstanceResourceMethods(GcloudResourceMethods):
             if usable:
                 try:
                     operation = start_instance(self.project_attrs.compute, self.project, self.project_attrs.zone, name)
-                    wait_for_operation(self.project_attrs.compute, self.project, self.project_attrs.zone, operation['name'])
+                    self.wait_for_operation(operation)
                     instance_data = list_instances(self.project_attrs.compute, self.project, self.project_attrs.zone, name=name)[0]
                     body["ip"] = str(instance_data['networkInterfaces'][0]['accessConfigs'][0]['natIP'])
 
@@ -143,7 +651,7 @@ class GcloudInstanceResourceMethods(GcloudResourceMethods):
             if usable == False:
                 try:
                     operation = stop_instance(self.project_attrs.compute, self.project, self.project_attrs.zone, name)
-                    wait_for_operation(self.project_attrs.compute, self.project, self.project_attrs.zone, operation['name'])
+                    self.wait_for_operation(operation)
 
                 except HttpError as e:
                     raise StandardError("Instance startup failed with status {0}".format(e.resp.status))
@@ -154,32 +662,48 @@ class GcloudInstanceResourceMethods(GcloudResourceMethods):
 
     def create_resource(self, body):
         if self.project_attrs:
-            try:
-                operation = create_instance(self.project_attrs.compute, self.project, self.project_attrs.zone,
-                                            body["name"], body["tags"],
-                                            disk_size=(body.get("disk_size") or '100'),
-                                            disk_type=(body.get("disk_type") or "pd-ssd"),
-                                            machine_type=(body.get("machine_type") or "n1-standard-8"))
-                wait_for_operation(self.project_attrs.compute, self.project, self.project_attrs.zone, operation['name'])
-                instance_data = list_instances(self.project_attrs.compute, self.project, self.project_attrs.zone, name=body['name'])[0]
-                body["ip"] = str(instance_data['networkInterfaces'][0]['accessConfigs'][0]['natIP'])
-                ResourceMethods.create_resource(self, body)
-
-            except HttpError as e:
-                if e.resp.status == 409:
-                    raise StandardError("Error! instance {0} already exists in gcloud.".format(body["name"]))
-                else:
-                    raise StandardError("Something went wrong during instance creation: {0}: {1}. \n".format(
-                        e.resp.status, e.resp.reason), e.content)
+            self.label_instance(body)
+            operation = self.insert_instance(body)
+            self.wait_for_operation(operation)
+            instance_data = list_instances(self.project_attrs.compute, self.project, self.project_attrs.zone, name=body['name'])[0]
+            body["ip"] = str(instance_data['networkInterfaces'][0]['accessConfigs'][0]['natIP'])
+            ResourceMethods.create_resource(self, body)
+            self.backend_config.inventory.invalidate(self.project)
         else:
             raise StandardError("Cannot create resource; no gcloud credentials for project {0}".format(self.project))
 
+    def label_instance(self, body):
+        # what the instance is made of can be selected on at allocation
+        body["labels"] = dict(body.get("labels") or {},
+                              tags=list(body["tags"]),
+                              zone=self.project_attrs.zone,
+                              machine_type=body.get("machine_type") or "n1-standard-8",
+                              disk_type=body.get("disk_type") or "pd-ssd",
+                              disk_size=body.get("disk_size") or "100")
+
+    def insert_instance(self, body):
+        """Sends the insert for a new instance and returns its operation without waiting on it."""
+        try:
+            return create_instance(self.project_attrs.compute, self.project, self.project_attrs.zone,
+                                   body["name"], body["tags"],
+                                   disk_size=(body.get("disk_size") or '100'),
+                                   disk_type=(body.get("disk_type") or "pd-ssd"),
+                                   machine_type=(body.get("machine_type") or "n1-standard-8"),
+                                   source_disk_image=self.backend_config.images.resolve(self.project_attrs))
+        except HttpError as e:
+            if e.resp.status == 409:
+                raise StandardError("Error! instance {0} already exists in gcloud.".format(body["name"]))
+            else:
+                raise StandardError("Something went wrong during instance creation: {0}: {1}. \n".format(
+                    e.resp.status, e.resp.reason), e.content)
+
     def delete_resource(self, name):
         if self.project_attrs:
             try:
                 operation = delete_instance(self.project_attrs.compute, self.project, self.project_attrs.zone, name)
-                wait_for_operation(self.project_attrs.compute, self.project, self.project_attrs.zone, operation['name'])
+                self.wait_for_operation(operation)
                 ResourceMethods.delete_resource(self, name)
+                self.backend_config.inventory.invalidate(self.project)
 
             except HttpError as e:
                 if e.resp.status == 404:
@@ -0,0 +1,202 @@
+"""
+Metrics class
+
+Counters and latency histograms kept in process and rendered in the Prometheus
+text format by GET /metrics. Routes are timed by request hooks, db queries by
+SQLAlchemy engine events and each outbound call (token checks, google APIs) by
+`outbound`, or the `timed` decorator for functions that make a single call.
+Gauges whose values live elsewhere, such as free resources per project, are
+read by collectors when the metrics are scraped.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._meta = {}  # name -> (type, help)
+        self._values = {}  # name -> {sorted label pairs -> count, or [bucket counts, sum, count]}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help):
+        with self._lock:
+            self._meta.setdefault(name, (kind, help))
+            self._values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    @contextmanager
+    def outbound(self, call):
+        """Records the latency, and any error, of one call out to google under `call`."""
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.inc('jacalloc_outbound_call_errors_total', call=call)
+            raise
+        finally:
+            self.observe('jacalloc_outbound_call_duration_seconds', time.time() - start, call=call)
+
+    def timed(self, fn):
+        """Decorator for functions that make exactly one outbound call, recorded under the function's name."""
+        @functools.wraps(fn)
+        def _wrap(*args, **kwargs):
+            with self.outbound(fn.__name__):
+                return fn(*args, **kwargs)
+        return _wrap
+
+    def add_collector(self, collect):
+        """`collect()` is called on every scrape and returns (name, type, help, [(labels, value)]) tuples."""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._meta):
+                kind, help = self._meta[name]
+                samples = self._values[name].items()
+                if kind == 'histogram':
+                    samples = [(k, ([c for c in h[0]], h[1], h[2])) for k, h in samples]
+                lines.extend(self._family(name, kind, help, sorted(samples)))
+        for collect in self._collectors:
+            try:
+                for name, kind, help, samples in collect():
+                    lines.extend(self._family(name, kind, help, [(tuple(sorted(l.items())), v) for l, v in samples]))
+            except Exception as e:
+                print "[WARN] Unable to collect metrics from {0}: {1}".format(getattr(collect, '__name__', collect), e)
+        return '\n'.join(lines) + '\n'
+
+    def _family(self, name, kind, help, samples):
+        lines = ['# HELP {0} {1}'.format(name, help), '# TYPE {0} {1}'.format(name, kind)]
+        for labels, value in samples:
+            if kind != 'histogram':
+                lines.append('{0}{1} {2}'.format(name, _labels(labels), _number(value)))
+                continue
+            counts, total, count = value
+            for bound, n in zip(self.buckets, counts):
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, [('le', _number(float(bound)))]), n))
+            lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, [('le', '+Inf')]), count))
+            lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), _number(total)))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels), count))
+        return lines
+
+
+REGISTRY = Metrics()
+REGISTRY.describe('jacalloc_http_request_duration_seconds', 'histogram', 'Time taken to handle a request, by route')
+REGISTRY.describe('jacalloc_http_requests_total', 'counter', 'Requests handled, by route and status code')
+REGISTRY.describe('jacalloc_db_query_duration_seconds', 'histogram', 'Time taken by db statements, by statement type')
+REGISTRY.describe('jacalloc_db_errors_total', 'counter', 'Db statements that raised, by statement type')
+REGISTRY.describe('jacalloc_outbound_call_duration_seconds', 'histogram', 'Time taken by calls to google, by function')
+REGISTRY.describe('jacalloc_outbound_call_errors_total', 'counter', 'Calls to google that raised, by function')
+
+
+timed = REGISTRY.timed
+outbound = REGISTRY.outbound
+
+
+def statement_type(statement):
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return verb if verb.isalpha() else 'OTHER'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    REGISTRY.observe('jacalloc_db_query_duration_seconds', time.time() - start, statement=statement_type(statement))
+
+
+def _handle_error(context):
+    starts = context.connection.info.get('query_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+    REGISTRY.inc('jacalloc_db_errors_total', statement=statement_type(context.statement or ''))
+
+
+def _route():
+    # the url rule rather than the path, so every resource name shares one series
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _before_request():
+    g.metrics_start = time.time()
+    g.metrics_recorded = False
+
+
+def _record(status):
+    if getattr(g, 'metrics_recorded', True):
+        return
+    g.metrics_recorded = True
+    route = _route()
+    REGISTRY.observe('jacalloc_http_request_duration_seconds', time.time() - g.metrics_start,
+                     method=request.method, route=route)
+    REGISTRY.inc('jacalloc_http_requests_total', method=request.method, route=route, status=status)
+
+
+def _after_request(response):
+    _record(response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    # requests that raised never reach after_request; they were answered with a 500
+    if exc is not None:
+        _record(500)
+
+
+def instrument_app(app):
+    """Times every request to `app` and every statement sent through SQLAlchemy."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
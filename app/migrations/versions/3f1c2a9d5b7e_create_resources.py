@@ -0,0 +1,35 @@
+"""create resources table
+
+Revision ID: 3f1c2a9d5b7e
+Revises: None
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d5b7e'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # databases created before migrations were checked in already have this table
+    if 'resources' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('resources',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('ip', sa.String(), nullable=True),
+    sa.Column('in_use', sa.Boolean(), nullable=True),
+    sa.Column('project', sa.String(), nullable=True),
+    sa.Column('private', sa.Boolean(), nullable=True),
+    sa.Column('usable', sa.Boolean(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('resources')
@@ -0,0 +1,38 @@
+"""index resource lookups, allocation and expiry
+
+Revision ID: 8a4e6d0c2f13
+Revises: 3f1c2a9d5b7e
+Create Date: 2026-10-18 15:20:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d0c2f13'
+down_revision = '3f1c2a9d5b7e'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the unique index cannot be built over duplicate rows, and which of them to keep (some may be
+    # allocated) is for an operator to decide, so stop and list them rather than delete any
+    if not context.is_offline_mode():
+        duplicates = op.get_bind().execute(sa.text(
+            "SELECT project, name, count(*) FROM resources GROUP BY project, name HAVING count(*) > 1 "
+            "ORDER BY project, name")).fetchall()
+        if duplicates:
+            raise StandardError(
+                "Cannot add a unique index on resources (name, project); remove the duplicate rows and "
+                "upgrade again:\n" + "\n".join("  project {0}, name {1}: {2} rows".format(p, n, c)
+                                               for p, n, c in duplicates))
+    op.create_index('ix_resources_name_project', 'resources', ['name', 'project'], unique=True)
+    op.create_index('ix_resources_free', 'resources', ['project'],
+                    postgresql_where=sa.text('in_use = false AND usable = true AND private = false'))
+    op.create_index('ix_resources_timestamp', 'resources', ['timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_resources_timestamp', table_name='resources')
+    op.drop_index('ix_resources_free', table_name='resources')
+    op.drop_index('ix_resources_name_project', table_name='resources')
@@ -0,0 +1,22 @@
+"""track resources the warm pool is stopping
+
+Revision ID: a93d5c1e7b46
+Revises: f48b1e6a2d93
+Create Date: 2026-10-18 21:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a93d5c1e7b46'
+down_revision = 'f48b1e6a2d93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resources', sa.Column('stopping_since', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('resources', 'stopping_since')
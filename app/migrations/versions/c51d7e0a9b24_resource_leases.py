@@ -0,0 +1,29 @@
+"""allocation leases
+
+Revision ID: c51d7e0a9b24
+Revises: 8a4e6d0c2f13
+Create Date: 2026-10-18 16:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c51d7e0a9b24'
+down_revision = '8a4e6d0c2f13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resources', sa.Column('lease_id', sa.String(), nullable=True))
+    op.add_column('resources', sa.Column('lease_expires', sa.DateTime(), nullable=True))
+    op.create_index('ix_resources_lease_id', 'resources', ['lease_id'])
+    op.create_index('ix_resources_lease_expires', 'resources', ['lease_expires'],
+                    postgresql_where=sa.text('lease_expires IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_resources_lease_expires', table_name='resources')
+    op.drop_index('ix_resources_lease_id', table_name='resources')
+    op.drop_column('resources', 'lease_expires')
+    op.drop_column('resources', 'lease_id')
@@ -0,0 +1,26 @@
+"""resource labels
+
+Revision ID: d2b8f4a61c07
+Revises: c51d7e0a9b24
+Create Date: 2026-10-18 16:40:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2b8f4a61c07'
+down_revision = 'c51d7e0a9b24'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column('resources', sa.Column('labels', postgresql.JSONB(), nullable=True,
+                                         server_default=sa.text("'{}'::jsonb")))
+    op.create_index('ix_resources_labels', 'resources', ['labels'], postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_resources_labels', table_name='resources')
+    op.drop_column('resources', 'labels')
@@ -0,0 +1,27 @@
+"""index resource name search
+
+Revision ID: e7a3c9d05f18
+Revises: d2b8f4a61c07
+Create Date: 2026-10-18 17:05:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e7a3c9d05f18'
+down_revision = 'd2b8f4a61c07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_resources_name_trgm', 'resources', ['name'],
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_resources_name_pattern', 'resources', ['name'],
+                    postgresql_ops={'name': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_resources_name_pattern', table_name='resources')
+    op.drop_index('ix_resources_name_trgm', table_name='resources')
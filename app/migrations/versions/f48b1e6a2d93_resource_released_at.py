@@ -0,0 +1,22 @@
+"""track when resources were released
+
+Revision ID: f48b1e6a2d93
+Revises: e7a3c9d05f18
+Create Date: 2026-10-18 18:40:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f48b1e6a2d93'
+down_revision = 'e7a3c9d05f18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resources', sa.Column('released_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('resources', 'released_at')
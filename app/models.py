@@ -1,4 +1,5 @@
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB
 import json
 from datetime import datetime, timedelta
 db = SQLAlchemy()
@@ -19,14 +20,24 @@ class Resource(BaseModel):
     private = db.Column(db.Boolean, default=False)
     usable = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=None)
+    # set while an allocation holds a lease; the lease sweeper frees the resource once it expires
+    lease_id = db.Column(db.String, default=None)
+    lease_expires = db.Column(db.DateTime, default=None)
+    # when the resource was last freed; the warm pool stops the longest idle resources first
+    released_at = db.Column(db.DateTime, default=None)
+    # set while the warm pool is stopping the resource, so the reconciler doesn't mark it usable in the meantime
+    stopping_since = db.Column(db.DateTime, default=None)
+    # selectable attributes, e.g. {"machine_type": "n1-standard-8", "tags": ["gpu"]}; GIN indexed on postgres
+    labels = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'), default=dict)
 
-    def __init__(self, name, ip, in_use, project, private=False, usable=False):
+    def __init__(self, name, ip, in_use, project, private=False, usable=False, labels=None):
         self.name = name
         self.ip = ip
         self.in_use = in_use
         self.project = project
         self.private = private
         self.usable = usable
+        self.labels = labels or {}
         self.timestamp = None
 
     def __repr__(self):
@@ -40,8 +51,19 @@ class Resource(BaseModel):
                 "in_use": self.in_use,
                 "private": self.private,
                 "usable": self.usable,
+                "labels": self.labels or {},
                 "time_running": str(self.get_time_running())}
 
+    def lease_map(self):
+        """The resource as returned to the holder of its lease."""
+        d = self.map()
+        d["lease_id"] = self.lease_id
+        d["lease_expires"] = self.lease_expires.isoformat() if self.lease_expires else None
+        return d
+
+    def is_free(self):
+        return not self.in_use and self.usable and not self.private
+
     def get_required_keys(self):
         return self.required_keys
 
@@ -56,6 +78,55 @@ class Resource(BaseModel):
             return False
 
 
+# fields a resource can be listed with; time_running is derived from timestamp
+FIELDS = ["name", "ip", "project", "in_use", "private", "usable", "labels", "time_running"]
+
+
+def parse_fields(fields):
+    """Parses a comma separated `fields` parameter; raises ValueError on unknown fields."""
+    if not fields:
+        return None
+    fields = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise ValueError("Unknown fields {0}; choose from {1}".format(unknown, FIELDS))
+    return fields
+
+
+def field_columns(fields):
+    names = ["id"] + ["timestamp" if f == "time_running" else f for f in fields]
+    return [getattr(Resource, n) for n in sorted(set(names), key=names.index)]
+
+
+def project_row(row, fields):
+    """Builds a resource dict holding only `fields` from a row of selected columns."""
+    d = {}
+    for f in fields:
+        if f == "time_running":
+            d[f] = str(datetime.now() - row.timestamp if row.timestamp else None)
+        elif f == "labels":
+            d[f] = row.labels or {}
+        else:
+            d[f] = getattr(row, f)
+    return d
+
+
+# (name, project) serves both the unique (project, name) constraint and lookups by name alone
+db.Index('ix_resources_name_project', Resource.name, Resource.project, unique=True)
+# the rows allocation picks from; kept small as most of a busy pool is in use
+db.Index('ix_resources_free', Resource.project,
+         postgresql_where=db.and_(Resource.in_use == False, Resource.usable == True, Resource.private == False))
+db.Index('ix_resources_timestamp', Resource.timestamp)
+# keyword search: trigrams serve substring (and regex) matches, the pattern ops index serves prefixes
+db.Index('ix_resources_name_trgm', Resource.name, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+db.Index('ix_resources_name_pattern', Resource.name, postgresql_ops={'name': 'varchar_pattern_ops'})
+# label selectors are containment (@>) and key (?) tests
+db.Index('ix_resources_labels', Resource.labels, postgresql_using='gin')
+# heartbeats and releases find a lease's resources by id; the sweeper only scans leased rows
+db.Index('ix_resources_lease_id', Resource.lease_id)
+db.Index('ix_resources_lease_expires', Resource.lease_expires, postgresql_where=Resource.lease_expires != None)
+
+
 #TODO: allow user to register more projects?
 # class Project(BaseModel):
 #     """Model for projects table"""
@@ -0,0 +1,76 @@
+"""
+Operation and OperationRegistry classes
+
+Slow resource changes (creating, starting, stopping or deleting VMs) can run on
+a worker pool instead of a request thread. The request returns an Operation
+right away and clients poll or wait on it through /operations/<id>.
+Operations live in memory and are forgotten `retention` seconds after they finish.
+"""
+import datetime
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+DONE = "DONE"
+ERROR = "ERROR"
+
+
+class Operation:
+
+    def __init__(self, kind, name):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.name = name
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.created = datetime.datetime.now()
+        self.finished = None
+        self.done = threading.Event()
+
+    def map(self):
+        return {"id": self.id,
+                "kind": self.kind,
+                "name": self.name,
+                "status": self.status,
+                "result": self.result,
+                "error": self.error,
+                "created": self.created.isoformat(),
+                "finished": self.finished.isoformat() if self.finished else None}
+
+
+class OperationRegistry:
+
+    def __init__(self, app, workers=4, retention=3600, maxsize=10000):
+        self.app = app
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._operations = TTLCache(maxsize=maxsize, ttl=retention)
+
+    def submit(self, kind, name, fn, *args):
+        """Queues fn(*args) to run inside an app context and returns its Operation."""
+        op = Operation(kind, name)
+        # keep unfinished operations around however long they sit in the queue
+        self._operations.set(op.id, op, ttl=float('inf'))
+        self._executor.submit(self._run, op, fn, args)
+        return op
+
+    def _run(self, op, fn, args):
+        op.status = RUNNING
+        with self.app.app_context():
+            try:
+                op.result = fn(*args)
+                op.status = DONE
+            except Exception as e:
+                op.error = str(e)
+                op.status = ERROR
+                print "[WARN] Operation {0} ({1} {2}) failed: {3}".format(op.id, op.kind, op.name, e)
+        op.finished = datetime.datetime.now()
+        self._operations.set(op.id, op)
+        op.done.set()
+
+    def get(self, op_id):
+        return self._operations.get(op_id)
@@ -0,0 +1,120 @@
+"""
+OperationPoller class
+
+Waits on google compute zone operations for every caller from one background
+thread. Pending operations are grouped by (project, zone) and each group is
+checked with a single filtered zoneOperations().list call per tick, so API use
+grows with the number of zones rather than the number of operations in flight.
+A group that sees no progress backs off towards `max_interval`.
+"""
+import threading
+import time
+from concurrent import futures
+from backends.gcloud import list_operations
+
+
+class OperationError(StandardError):
+    pass
+
+
+class _ZoneOperations:
+
+    def __init__(self):
+        self.pending = {}  # operation name -> Future
+        self.interval = None
+        self.next_poll = float('inf')
+
+
+class OperationPoller:
+
+    def __init__(self, backend_config, min_interval=1, max_interval=10, backoff=1.5):
+        self.backend_config = backend_config
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.stats = {"polls": 0, "completed": 0, "failed": 0, "errors": 0}
+        self._zones = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, project, zone, operation):
+        """Returns a Future for the named zone operation. It resolves to the finished
+        operation, or raises OperationError if google reports the operation failed."""
+        future = futures.Future()
+        with self._cond:
+            z = self._zones.setdefault((project, zone), _ZoneOperations())
+            z.pending[operation] = future
+            # new work is checked soon, however far the zone had backed off
+            z.interval = self.min_interval
+            z.next_poll = min(z.next_poll, time.time() + self.min_interval)
+            if self._thread:
+                self._cond.notify()
+            else:
+                # the poller thread only runs while there are operations to wait on
+                self._thread = threading.Thread(target=self._run, name="operation-poller")
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def wait(self, project, zone, operation, timeout=None):
+        future = self.submit(project, zone, operation)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise OperationError("Timed out waiting for operation {0} in {1}/{2}".format(operation, project, zone))
+
+    def pending(self):
+        with self._cond:
+            return sum(len(z.pending) for z in self._zones.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._zones:
+                    self._thread = None
+                    return
+                now = time.time()
+                due = [(key, z, z.pending.keys()) for key, z in self._zones.items() if z.next_poll <= now]
+                if not due:
+                    self._cond.wait(min(z.next_poll for z in self._zones.values()) - now)
+                    continue
+            for key, z, names in due:
+                self.poll_zone(key, z, names)
+
+    def poll_zone(self, key, z, names):
+        project, zone = key
+        finished = []
+        failed = False
+        try:
+            compute = self.backend_config.projects[project].compute
+            finished = [op for op in list_operations(compute, project, zone, names) if op.get('status') == 'DONE']
+        except Exception as e:
+            failed = True
+            print "[WARN] Unable to poll operations in {0}/{1}: {2}".format(project, zone, e)
+
+        with self._cond:
+            self.stats["polls"] += 1
+            if failed:
+                self.stats["errors"] += 1
+            for op in finished:
+                future = z.pending.pop(op['name'], None)
+                if future is None or not future.set_running_or_notify_cancel():
+                    continue
+                if 'error' in op:
+                    self.stats["failed"] += 1
+                    future.set_exception(OperationError(op['error']))
+                else:
+                    self.stats["completed"] += 1
+                    future.set_result(op)
+            for name in [n for n, f in z.pending.items() if f.cancelled()]:
+                del z.pending[name]
+
+            if not z.pending:
+                del self._zones[key]
+                return
+            if finished:
+                z.interval = self.min_interval
+            else:
+                z.interval = min(z.interval * self.backoff, self.max_interval)
+            z.next_poll = time.time() + z.interval
@@ -0,0 +1,172 @@
+"""
+WarmPool class
+
+Keeps a number of free, usable resources ready in each project so allocations
+are a db claim rather than a VM boot. Each pass tops a project up by starting
+stopped resources (and, if allowed, creating new instances), and stops the
+surplus once a project has had more than it needs for `cooldown` seconds.
+"""
+import threading
+import time
+import datetime
+import uuid
+from contextlib import contextmanager
+from sqlalchemy import text
+from models import db, Resource
+
+
+@contextmanager
+def project_lock(project):
+    """Yields whether this process may balance `project`. On postgres only one process at a time holds a
+    project's advisory lock, so pools in several processes don't each fill the same shortfall."""
+    if db.engine.dialect.name != 'postgresql':
+        yield True
+        return
+    key = "jacalloc-warm-pool:" + project
+    # session locks belong to a connection, so the same one has to release it
+    conn = db.engine.connect()
+    try:
+        locked = conn.execute(text("SELECT pg_try_advisory_lock(hashtext(:key))"), key=key).scalar()
+        try:
+            yield locked
+        finally:
+            if locked:
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), key=key)
+    finally:
+        conn.close()
+
+
+class WarmPool:
+
+    def __init__(self, app, resource_methods, backend_config, size, interval=60, cooldown=900,
+                 create=False, name_prefix="warm", tags=None):
+        self.app = app
+        self.resource_methods = resource_methods
+        self.backend_config = backend_config
+        self.size = size
+        self.interval = interval
+        self.cooldown = cooldown
+        self.create = create
+        self.name_prefix = name_prefix
+        self.tags = tags or []
+        self.stats = {"runs": 0, "started": 0, "created": 0, "stopped": 0, "errors": 0,
+                      "last_run": None, "last_duration": None}
+        # project -> when it was first seen with more warm resources than it needs
+        self._surplus_since = {}
+        self._thread = None
+
+    def start(self):
+        """Tops up the pool every `interval` seconds from a background thread."""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self.run_forever, name="warm-pool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run_forever(self):
+        while True:
+            with self.app.app_context():
+                self.run_once()
+            time.sleep(self.interval)
+
+    def run_once(self):
+        start = time.time()
+        for project, attrs in self.backend_config.projects.items():
+            try:
+                with project_lock(project) as locked:
+                    if locked:
+                        self.balance_project(project, self.target(attrs))
+            except Exception as e:
+                db.session.rollback()
+                self.stats["errors"] += 1
+                print "[WARN] Unable to balance the warm pool for project {0}: {1}".format(project, e)
+
+        self.stats["runs"] += 1
+        self.stats["last_run"] = datetime.datetime.now().isoformat()
+        self.stats["last_duration"] = time.time() - start
+        return self.stats
+
+    def target(self, attrs):
+        size = getattr(attrs, "warm_pool_size", None)
+        return self.size if size is None else size
+
+    def free_query(self, project):
+        return Resource.query.filter_by(project=project, in_use=False, private=False)
+
+    def balance_project(self, project, target):
+        warm = self.free_query(project).filter_by(usable=True).count()
+        if warm < target:
+            self._surplus_since.pop(project, None)
+            self.fill(project, target - warm)
+        elif warm > target:
+            since = self._surplus_since.setdefault(project, time.time())
+            if time.time() - since >= self.cooldown:
+                self.drain(project, warm - target)
+                self._surplus_since.pop(project, None)
+        else:
+            self._surplus_since.pop(project, None)
+
+    def fill(self, project, count):
+        stopped = [name for (name,) in self.free_query(project).filter_by(usable=False)
+                   .with_entities(Resource.name).order_by(Resource.id).limit(count)]
+        if stopped:
+            results = self.resource_methods.bulk_action('start', stopped, project=project)
+            started = len([n for n, e in results.items() if e is None])
+            self.stats["started"] += started
+            count -= started
+        if not self.create or count <= 0:
+            return
+        # all the new instances boot at once
+        bodies = [{"name": "{0}-{1}".format(self.name_prefix, uuid.uuid4().hex[:12]), "project": project,
+                   "tags": self.tags, "in_use": False, "private": False, "usable": True} for _ in range(count)]
+        results = self.resource_methods.create_resources(bodies)
+        failed = dict((n, e) for n, e in results.items() if e is not None)
+        self.stats["created"] += len(results) - len(failed)
+        if failed:
+            self.stats["errors"] += len(failed)
+            print "[WARN] Unable to create {0} warm resources in project {1}: {2}".format(
+                len(failed), project, "; ".join(sorted(set(failed.values()))))
+
+    def drain(self, project, count):
+        # the longest idle resources go first (never released ones before any that were); marking them
+        # unusable in the same transaction that locks them keeps them from being claimed while they are stopped,
+        # and stopping_since keeps the reconciler from making them usable again before google sees the stop
+        idle = self.free_query(project).filter_by(usable=True) \
+            .order_by(Resource.released_at.asc().nullsfirst(), Resource.id) \
+            .with_for_update(skip_locked=True).limit(count).all()
+        names = [r.name for r in idle]
+        now = datetime.datetime.now()
+        for r in idle:
+            r.usable = False
+            r.stopping_since = now
+        db.session.commit()
+        if not names:
+            return
+        stopping = Resource.query.filter(Resource.project == project).filter(Resource.name.in_(names))
+        try:
+            results = self.resource_methods.bulk_action('stop', names, project=project)
+        except Exception:
+            # whether the stops went out is unknown; once unmarked, the reconciler settles them from google
+            db.session.rollback()
+            stopping.update({'stopping_since': None}, synchronize_session=False)
+            db.session.commit()
+            raise
+        failed = [n for n, e in results.items() if e is not None]
+        if failed:
+            # still running; hand them back to the pool
+            stopping.filter(Resource.name.in_(failed)).update({'usable': True}, synchronize_session=False)
+        stopping.update({'stopping_since': None}, synchronize_session=False)
+        db.session.commit()
+        self.stats["stopped"] += len(names) - len(failed)
+
+def generate_warm_pool(backend, app, resource_methods, backend_config, config):
+    if backend == 'gce' and (config['WARM_POOL_SIZE'] > 0 or
+                             any(getattr(p, 'warm_pool_size', None) for p in backend_config.projects.values())):
+        return WarmPool(app, resource_methods, backend_config, config['WARM_POOL_SIZE'],
+                        interval=config['WARM_POOL_INTERVAL'],
+                        cooldown=config['WARM_POOL_COOLDOWN'],
+                        create=config['WARM_POOL_CREATE'],
+                        name_prefix=config['WARM_POOL_NAME_PREFIX'],
+                        tags=config['WARM_POOL_TAGS'])
+    else:
+        return None
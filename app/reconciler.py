@@ -0,0 +1,108 @@
+"""
+Reconciler class
+
+Repairs drift between google and the resources table in bulk. Each pass lists
+every instance in a project once, removes rows whose instance is gone and
+refreshes ip, usable and google's labels (tags, machine type, zone) on the
+rest, so requests can trust the db.
+"""
+import threading
+import time
+import datetime
+from models import db, Resource
+from backends.gcloud import list_all_instances, nat_ip
+
+# instances in other states are mid-transition; leave usable alone until they settle
+USABLE_BY_STATUS = {"RUNNING": True, "STOPPED": False, "TERMINATED": False, "SUSPENDED": False}
+
+
+def instance_labels(instance):
+    """Labels google knows for an instance; they are merged over any labels set through the api."""
+    return {"tags": instance.get('tags', {}).get('items', []),
+            "machine_type": instance.get('machineType', '').rsplit('/', 1)[-1],
+            "zone": instance.get('zone', '').rsplit('/', 1)[-1]}
+
+
+class Reconciler:
+
+    def __init__(self, app, backend_config, interval=60):
+        self.app = app
+        self.backend_config = backend_config
+        self.interval = interval
+        self.stats = {"runs": 0, "removed": 0, "updated": 0, "errors": 0,
+                      "last_run": None, "last_duration": None}
+        self._thread = None
+
+    def start(self):
+        """Reconciles every `interval` seconds from a background thread."""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self.run_forever, kwargs={"delay": self.interval}, name="reconciler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run_forever(self, delay=0):
+        time.sleep(delay)
+        while True:
+            with self.app.app_context():
+                self.run_once()
+            time.sleep(self.interval)
+
+    def run_once(self):
+        start = time.time()
+        removed = updated = 0
+        for project, attrs in self.backend_config.projects.items():
+            try:
+                r, u = self.reconcile_project(project, attrs)
+                removed += r
+                updated += u
+            except Exception as e:
+                db.session.rollback()
+                self.stats["errors"] += 1
+                print "[WARN] Unable to reconcile project {0}: {1}".format(project, e)
+
+        self.stats["runs"] += 1
+        self.stats["removed"] += removed
+        self.stats["updated"] += updated
+        self.stats["last_run"] = datetime.datetime.now().isoformat()
+        self.stats["last_duration"] = time.time() - start
+        print "[INFO] Reconciled {0} projects: removed {1}, updated {2} resources in {3:.2f}s".format(
+            len(self.backend_config.projects), removed, updated, self.stats["last_duration"])
+        return self.stats
+
+    def reconcile_project(self, project, attrs):
+        # read rows before listing instances: a row is only written once its instance exists,
+        # so anything missing from the later listing really is gone
+        rows = db.session.query(Resource.id, Resource.name, Resource.ip, Resource.usable, Resource.labels,
+                                Resource.stopping_since).filter(Resource.project == project).all()
+        instances = dict((i['name'], i) for i in list_all_instances(attrs.compute, project, attrs.zone))
+        self.backend_config.inventory.set(project, frozenset(instances))
+
+        gone = [r.id for r in rows if r.name not in instances]
+        # a stop that has been pending longer than an operation may take was abandoned
+        stop_cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.backend_config.OPERATION_TIMEOUT)
+        changes = []
+        for r in rows:
+            instance = instances.get(r.name)
+            if not instance or (r.stopping_since and r.stopping_since > stop_cutoff):
+                # gone, or still running until the warm pool's stop reaches google
+                continue
+            ip = nat_ip(instance) or r.ip
+            usable = USABLE_BY_STATUS.get(instance.get('status'), r.usable)
+            labels = dict(r.labels or {}, **instance_labels(instance))
+            if ip != r.ip or usable != r.usable or labels != r.labels:
+                changes.append({"id": r.id, "ip": ip, "usable": usable, "labels": labels})
+
+        if gone:
+            Resource.query.filter(Resource.id.in_(gone)).delete(synchronize_session=False)
+        if changes:
+            db.session.bulk_update_mappings(Resource, changes)
+        db.session.commit()
+        return len(gone), len(changes)
+
+
+def generate_reconciler(backend, app, backend_config, interval):
+    if backend == 'gce' and interval > 0:
+        return Reconciler(app, backend_config, interval=interval)
+    else:
+        return None
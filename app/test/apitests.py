@@ -8,13 +8,16 @@ from oauth2client.service_account import ServiceAccountCredentials
 
 HTTP_OK = 200
 HTTP_CREATED = 201
+HTTP_ACCEPTED = 202
 HTTP_BAD_REQUEST = 400
 HTTP_UNAUTHORIZED = 401
+HTTP_FORBIDDEN = 403
 HTTP_CONFLICT = 409
 HTTP_NOT_FOUND = 404
 HTTP_NO_CONTENT = 204
 HTTP_PRECONDITION_FAILED = 412
 HTTP_METHOD_NOT_ALLOWED = 405
+HTTP_NOT_IMPLEMENTED = 501
 
 
 def get_user_token(user_email, json_keyfile_dict):
@@ -62,6 +65,24 @@ class TestCreateApi(unittest.TestCase):
         response = requests.get(self.base_url)
         self.assertEqual(response.status_code, HTTP_OK)
 
+    def test_metrics(self):
+        requests.get(self.base_url)
+        response = requests.get(self.base_url + "metrics")
+        self.assertEqual(response.status_code, HTTP_OK)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        self.assertIn('jacalloc_http_requests_total{method="GET",route="/",status="200"}', response.text)
+        self.assertIn("jacalloc_resources", response.text)
+
+    def test_invalidate_auth_cache(self):
+        response = requests.delete(self.base_url + "auth/cache", headers=self.headers, params={"user": self.delegated_user})
+        self.assertEqual(response.status_code, HTTP_NO_CONTENT)
+
+    def test_invalidate_auth_cache_of_others(self):
+        response = requests.delete(self.base_url + "auth/cache", headers=self.headers, params={"user": "someone@else.org"})
+        self.assertEqual(response.status_code, HTTP_FORBIDDEN)
+        response = requests.delete(self.base_url + "auth/cache", headers=self.headers)
+        self.assertEqual(response.status_code, HTTP_FORBIDDEN)
+
     def test_resource_create_and_delete(self):
         create = self.create_record_body()
         response = requests.post(self.base_url_resources, headers=self.headers, data=json.dumps(create))
@@ -70,6 +91,58 @@ class TestCreateApi(unittest.TestCase):
         delete = requests.delete(self.base_url_resources + "/" + create["name"], headers=self.headers)
         self.assertEqual(delete.status_code, HTTP_NO_CONTENT)
 
+    def test_resource_create_and_delete_async(self):
+        create = self.create_record_body()
+        response = requests.post(self.base_url_resources, headers=self.headers, data=json.dumps(create), params={"async": "true"})
+        self.assertEqual(response.status_code, HTTP_ACCEPTED)
+        op = requests.get(self.base_url + "operations/" + response.json()["id"], headers=self.headers, params={"wait": 60})
+        self.assertEqual(op.json()["status"], "DONE")
+
+        delete = requests.delete(self.base_url_resources + "/" + create["name"], headers=self.headers, params={"async": "true"})
+        self.assertEqual(delete.status_code, HTTP_ACCEPTED)
+        op = requests.get(self.base_url + "operations/" + delete.json()["id"], headers=self.headers, params={"wait": 60})
+        self.assertEqual(op.json()["status"], "DONE")
+
+    def test_bulk_stop_and_delete(self):
+        names = []
+        for _ in range(2):
+            create = self.create_record_body()
+            response = requests.post(self.base_url_resources, headers=self.headers, data=json.dumps(create))
+            self.assertEqual(response.status_code, HTTP_CREATED)
+            names.append(create["name"])
+
+        stop = requests.post(self.base_url_resources + "/bulk/stop", headers=self.headers, data=json.dumps({"names": names}))
+        self.assertEqual(stop.status_code, HTTP_OK)
+        self.assertEqual(sorted(stop.json()["succeeded"]), sorted(names))
+        for name in names:
+            self.assertFalse(requests.get(self.base_url_resources + "/" + name, headers=self.headers).json()["usable"])
+
+        delete = requests.post(self.base_url_resources + "/bulk/delete", headers=self.headers,
+                               data=json.dumps({"names": names + ["not-a-resource"]}))
+        self.assertEqual(delete.status_code, HTTP_OK)
+        self.assertEqual(sorted(delete.json()["succeeded"]), sorted(names))
+        self.assertIn("not-a-resource", delete.json()["failed"])
+
+    def test_batch_invalid_item(self):
+        response = requests.post(self.base_url_resources + "/batch", headers=self.headers,
+                                 data=json.dumps([{"op": "create", "body": {"name": "missing-fields"}}]))
+        self.assertEqual(response.status_code, HTTP_BAD_REQUEST)
+        self.assertFalse(response.json()["committed"])
+
+    def test_batch_not_found_rolls_back(self):
+        response = requests.post(self.base_url_resources + "/batch", headers=self.headers,
+                                 data=json.dumps([{"op": "delete", "name": "not-a-resource"}]))
+        self.assertEqual(response.status_code, HTTP_CONFLICT)
+        self.assertEqual(response.json()["results"][0]["status"], HTTP_NOT_FOUND)
+
+    def test_bulk_unknown_action(self):
+        response = requests.post(self.base_url_resources + "/bulk/reboot", headers=self.headers, data=json.dumps({"names": ["a"]}))
+        self.assertEqual(response.status_code, HTTP_NOT_FOUND)
+
+    def test_get_operation_not_found(self):
+        response = requests.get(self.base_url + "operations/not-an-operation", headers=self.headers)
+        self.assertEqual(response.status_code, HTTP_NOT_FOUND)
+
     def test_resource_create_empty_body(self):
         response = requests.post(self.base_url_resources, headers=self.headers, data={})
         self.assertEqual(response.status_code, HTTP_BAD_REQUEST)
@@ -167,6 +240,42 @@ class TestDependentApi(unittest.TestCase):
         self.assert_record_is_not_in_list(resp.json(), self.resource_name)
 
 
+    def test_get_resources_paginated(self):
+        page = requests.get(self.base_url_resources, headers=self.headers, params={"limit": 1})
+        self.assertEqual(page.status_code, HTTP_OK)
+        self.assertEqual(len(page.json()), 1)
+        self.assertIn("X-Next-Cursor", page.headers)
+
+        next_page = requests.get(self.base_url_resources, headers=self.headers,
+                                 params={"limit": 1, "after": page.headers["X-Next-Cursor"]})
+        self.assertEqual(next_page.status_code, HTTP_OK)
+        self.assert_record_is_not_in_list(next_page.json(), page.json()[0]["name"])
+
+    def test_get_resources_ndjson(self):
+        resp = requests.get(self.base_url_resources, headers=self.headers, params={"format": "ndjson"})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        records = [json.loads(line) for line in resp.text.splitlines()]
+        self.assert_record_is_in_list(records, self.resource_name)
+
+    def test_get_resources_bad_limit(self):
+        for limit in ["abc", "0"]:
+            resp = requests.get(self.base_url_resources, headers=self.headers, params={"limit": limit})
+            self.assertEqual(resp.status_code, HTTP_BAD_REQUEST)
+
+    def test_get_resources_bad_cursor(self):
+        resp = requests.get(self.base_url_resources, headers=self.headers, params={"after": "not-a-cursor"})
+        self.assertEqual(resp.status_code, HTTP_BAD_REQUEST)
+
+    def test_get_resources_fields(self):
+        resp = requests.get(self.base_url_resources, headers=self.headers, params={"fields": "name,ip"})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        for r in resp.json():
+            self.assertEqual(set(r.keys()), {"name", "ip"})
+
+    def test_get_resources_bad_fields(self):
+        resp = requests.get(self.base_url_resources, headers=self.headers, params={"fields": "name,not-a-field"})
+        self.assertEqual(resp.status_code, HTTP_BAD_REQUEST)
+
     def test_get_resources_bad_proj(self):
         resp = requests.get(self.base_url_resources, headers=self.headers, params={"project": "not-a-real-proj"})
         self.assertEqual(resp.json(), [])
@@ -235,6 +344,20 @@ class TestDependentApi(unittest.TestCase):
         self.assertEqual(resp.json(), [])
         self.assertEqual(resp.status_code, HTTP_OK)
 
+    def test_get_resource_by_keyword_prefix(self):
+        resp = requests.get(self.base_url_resources + "/name/testallocatorapi", headers=self.headers, params={"mode": "prefix"})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assert_record_is_in_list(resp.json(), self.resource_name)
+
+    def test_get_resource_by_keyword_regex(self):
+        resp = requests.get(self.base_url_resources + "/name/^testallocatorapi-.*", headers=self.headers, params={"mode": "regex"})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assert_record_is_in_list(resp.json(), self.resource_name)
+
+    def test_get_resource_by_keyword_bad_mode(self):
+        resp = requests.get(self.base_url_resources + "/name/testallocatorapi", headers=self.headers, params={"mode": "glob"})
+        self.assertEqual(resp.status_code, HTTP_BAD_REQUEST)
+
     def test_get_resource_by_keyword_unauthed(self):
         # no token
         resp = requests.get(self.base_url_resources + "/name/testallocatorapi", headers={"Content-Type": "application/json"})
@@ -315,6 +438,49 @@ class TestDependentApi(unittest.TestCase):
     def test_allocate_within_false_project(self):
         self.allocate_and_free(self.resource_name, parameters={"project": "not-a-real-proj"}, allocate_status=HTTP_PRECONDITION_FAILED)
 
+    def test_allocate_batch(self):
+        resp1 = requests.post(self.base_url_resources + "/" + self.resource_name, headers=self.headers, data=json.dumps({"usable": True}))
+        self.assertEqual(resp1.status_code, HTTP_OK)
+        resp2 = requests.post(self.base_url_resources + "/allocate/batch", headers=self.headers,
+                              params={"project": self.project, "count": 1, "mode": "best_effort"})
+        self.assertEqual(resp2.status_code, HTTP_OK)
+        self.assertEqual(len(resp2.json()), 1)
+        self.assertTrue(resp2.json()[0]["in_use"])
+        self.free(resp2.json()[0])
+
+    def test_allocate_with_lease(self):
+        resp1 = requests.post(self.base_url_resources + "/" + self.resource_name, headers=self.headers, data=json.dumps({"usable": True}))
+        self.assertEqual(resp1.status_code, HTTP_OK)
+        resp2 = requests.post(self.base_url_resources + "/allocate", headers=self.headers,
+                              params={"project": self.project, "lease": 60})
+        self.assertEqual(resp2.status_code, HTTP_OK)
+        lease_id = resp2.json()["lease_id"]
+        self.assertTrue(lease_id)
+
+        heartbeat = requests.post(self.base_url + "leases/" + lease_id + "/heartbeat", headers=self.headers, params={"ttl": 60})
+        self.assertEqual(heartbeat.status_code, HTTP_OK)
+        release = requests.delete(self.base_url + "leases/" + lease_id, headers=self.headers)
+        self.assertEqual(release.status_code, HTTP_NO_CONTENT)
+        self.assertFalse(requests.get(self.base_url_resources + "/" + resp2.json()["name"], headers=self.headers).json()["in_use"])
+
+    def test_allocate_selector_no_match(self):
+        response = requests.post(self.base_url_resources + "/allocate", headers=self.headers,
+                                 params={"project": self.project, "selector": "machine_type=not-a-machine-type"})
+        self.assertEqual(response.status_code, HTTP_PRECONDITION_FAILED)
+
+    def test_invalid_selector(self):
+        response = requests.get(self.base_url_resources, headers=self.headers, params={"selector": "tags in gpu"})
+        self.assertEqual(response.status_code, HTTP_BAD_REQUEST)
+
+    def test_heartbeat_unknown_lease(self):
+        response = requests.post(self.base_url + "leases/not-a-lease/heartbeat", headers=self.headers, params={"ttl": 60})
+        self.assertEqual(response.status_code, HTTP_NOT_FOUND)
+
+    def test_allocate_batch_not_enough_free(self):
+        resp = requests.post(self.base_url_resources + "/allocate/batch", headers=self.headers,
+                             params={"project": "not-a-real-proj", "count": 2, "mode": "all"})
+        self.assertEqual(resp.status_code, HTTP_PRECONDITION_FAILED)
+
     def test_allocate_unauthed(self):
         # no token
         resp = requests.post(self.base_url_resources + "/allocate", headers={"Content-Type": "application/json"})
@@ -354,6 +520,12 @@ class TestCreateApiGcloud(TestCreateApi):
                             "zone": "us-central1-a"}
         self.headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.token}
 
+    def test_batch_not_found_rolls_back(self):
+        # batch changes are only supported by the default backend
+        response = requests.post(self.base_url_resources + "/batch", headers=self.headers,
+                                 data=json.dumps([{"op": "delete", "name": "not-a-resource"}]))
+        self.assertEqual(response.status_code, HTTP_NOT_IMPLEMENTED)
+
 
 class TestDependentApiGcloud(TestDependentApi):
 
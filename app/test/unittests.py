@@ -0,0 +1,1076 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import datetime
+import rsa
+import httplib2
+from oauth2client import crypt
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+from idtokens import IdTokenVerifier, StaticKeySource, generate_id_token_verifier
+from waiters import AllocationQueue
+from poller import OperationPoller, OperationError
+from images import ImageResolver
+from backends import gcloud
+from config import GcloudConfig, GcloudProjConfig
+from checkers import CheckRequest, CheckRequestGcloud
+from labels import parse_selector, selector_clause
+from metrics import Metrics
+from flask import Flask
+from sqlalchemy.dialects import postgresql
+from models import db, Resource
+from pool import WarmPool
+from reconciler import Reconciler
+from methods import ResourceMethods, GcloudResourceMethods, GcloudInstanceResourceMethods
+from methods import encode_cursor, decode_cursor, escape_like
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = TTLCache(maxsize=4, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", "hermione@example.com")
+        self.assertEqual(cache.get("a"), "hermione@example.com")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_expiry(self):
+        cache = TTLCache(maxsize=4, ttl=60)
+        cache.set("a", False, ttl=0)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_invalidate(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+
+
+class TestIdTokenVerifier(unittest.TestCase):
+    """Verifies tokens minted by a local fake issuer."""
+
+    @classmethod
+    def setUpClass(cls):
+        public, private = rsa.newkeys(1024)
+        cls.signer = crypt.Signer.from_string(private.save_pkcs1())
+        cls.verifier = IdTokenVerifier(StaticKeySource({"fake-kid": public.save_pkcs1()}), audience="jacalloc")
+
+    def make_token(self, **claims):
+        payload = {"iss": "https://accounts.google.com",
+                   "aud": "jacalloc",
+                   "email": "hermione.owner@test.firecloud.org",
+                   "email_verified": True,
+                   "iat": int(time.time()),
+                   "exp": int(time.time()) + 3600}
+        payload.update(claims)
+        return crypt.make_signed_jwt(self.signer, payload, key_id="fake-kid")
+
+    def test_valid_token(self):
+        token = "Bearer " + self.make_token()
+        self.assertEqual(self.verifier.validate_token(token), "hermione.owner@test.firecloud.org")
+
+    def test_expired_token(self):
+        self.assertIsNone(self.verifier.validate_token(self.make_token(exp=int(time.time()) - 3600)))
+
+    def test_wrong_audience(self):
+        self.assertIsNone(self.verifier.validate_token(self.make_token(aud="someone-else")))
+
+    def test_wrong_issuer(self):
+        self.assertIsNone(self.verifier.validate_token(self.make_token(iss="https://evil.example.com")))
+
+    def test_tampered_token(self):
+        header, payload, signature = self.make_token().split(".")
+        self.assertIsNone(self.verifier.validate_token(".".join([header, payload[:-2] + "AA", signature])))
+
+    def test_not_a_jwt(self):
+        self.assertIsNone(self.verifier.validate_token("Bearer ya29.not-a-jwt"))
+
+    def test_missing_audience(self):
+        self.assertIsNone(self.verifier.validate_token(self.make_token(aud=None)))
+
+    def test_audience_required(self):
+        with self.assertRaises(ValueError):
+            generate_id_token_verifier('idtoken', audience=None)
+
+
+class TestAllocationQueue(unittest.TestCase):
+
+    def test_times_out(self):
+        queue = AllocationQueue(poll_interval=0.05)
+        self.assertIsNone(queue.wait(lambda: None, 0.1))
+        self.assertEqual(queue.waiting(), 0)
+
+    def test_waiters_served_in_order(self):
+        queue = AllocationQueue(poll_interval=0.05)
+        free = []
+        served = []
+
+        def claim():
+            return free.pop(0) if free else None
+
+        def waiter(name):
+            if queue.wait(claim, 5):
+                served.append(name)
+
+        threads = []
+        for name in ["first", "second"]:
+            t = threading.Thread(target=waiter, args=(name,))
+            t.start()
+            threads.append(t)
+            time.sleep(0.1)
+        free.extend(["r1", "r2"])
+        queue.notify()
+        for t in threads:
+            t.join()
+        self.assertEqual(served, ["first", "second"])
+
+
+class FakeZoneOperations:
+    """Stands in for compute.zoneOperations(); operations finish after `ticks` list calls."""
+
+    def __init__(self, ticks):
+        self.ticks = ticks
+        self.calls = 0
+
+    def list(self, project, zone, filter):
+        self.calls += 1
+        names = filter[len("name eq '("):-len(")'")].split("|")
+        done = self.calls >= self.ticks
+        items = [{"name": n, "status": "DONE" if done else "RUNNING"} for n in names]
+        if done and "op-bad" in names:
+            items[names.index("op-bad")]["error"] = {"errors": [{"code": "QUOTA_EXCEEDED"}]}
+        return FakeRequest({"items": items})
+
+    def list_next(self, previous_request, previous_response):
+        return None
+
+
+class FakeRequest:
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeImages:
+    """Stands in for compute.images(); each getFromFamily call returns a newer image."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def getFromFamily(self, project, family):
+        self.calls += 1
+        return FakeRequest({"selfLink": "projects/{0}/global/images/{1}-v{2}".format(project, family, self.calls)})
+
+
+class FakeCompute:
+    """Stands in for a compute client, serving whichever fake collections a test needs."""
+
+    def __init__(self, operations=None, images=None, instances=None):
+        self.operations = operations
+        self.fake_images = images
+        self.fake_instances = instances
+
+    def zoneOperations(self):
+        return self.operations
+
+    def images(self):
+        return self.fake_images
+
+    def instances(self):
+        return self.fake_instances
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback)
+
+
+class FakeProject:
+    """Stands in for a GcloudProjConfig."""
+
+    def __init__(self, compute, image_project="ubuntu-os-cloud", image_family="ubuntu-1604-lts"):
+        self.compute = compute
+        self.zone = "us-central1-a"
+        self.image_project = image_project
+        self.image_family = image_family
+
+
+class FakeBackendConfig:
+
+    def __init__(self, compute):
+        self.projects = {"broad-dsde-dev": FakeProject(compute)}
+
+
+class TestOperationPoller(unittest.TestCase):
+
+    def test_operations_in_a_zone_share_polls(self):
+        operations = FakeZoneOperations(ticks=3)
+        poller = OperationPoller(FakeBackendConfig(FakeCompute(operations=operations)), min_interval=0.01, max_interval=0.05)
+        # holding the poller's lock keeps it from polling until every operation is in
+        with poller._cond:
+            futures = [poller.submit("broad-dsde-dev", "us-central1-a", "op-{0}".format(i)) for i in range(20)]
+        for f in futures:
+            self.assertEqual(f.result(5)["status"], "DONE")
+        self.assertEqual(operations.calls, 3)
+        self.assertEqual(poller.pending(), 0)
+
+    def test_failed_operation(self):
+        operations = FakeZoneOperations(ticks=1)
+        poller = OperationPoller(FakeBackendConfig(FakeCompute(operations=operations)), min_interval=0.01)
+        with self.assertRaises(OperationError):
+            poller.wait("broad-dsde-dev", "us-central1-a", "op-bad", timeout=5)
+
+    def test_times_out(self):
+        operations = FakeZoneOperations(ticks=1000)
+        poller = OperationPoller(FakeBackendConfig(FakeCompute(operations=operations)), min_interval=0.01,
+                                 max_interval=0.01)
+        with self.assertRaises(OperationError):
+            poller.wait("broad-dsde-dev", "us-central1-a", "op-slow", timeout=0.1)
+
+
+class TestImageResolver(unittest.TestCase):
+
+    def test_family_resolved_once_across_projects(self):
+        images = FakeImages()
+        resolver = ImageResolver(ttl=60)
+        first = resolver.resolve(FakeProject(FakeCompute(images=images)))
+        second = resolver.resolve(FakeProject(FakeCompute(images=images)))
+        self.assertEqual(first, "projects/ubuntu-os-cloud/global/images/ubuntu-1604-lts-v1")
+        self.assertEqual(first, second)
+        self.assertEqual(images.calls, 1)
+
+    def test_families_cached_separately(self):
+        images = FakeImages()
+        resolver = ImageResolver(ttl=60)
+        resolver.resolve(FakeProject(FakeCompute(images=images)))
+        other = resolver.resolve(FakeProject(FakeCompute(images=images), image_family="ubuntu-1804-lts"))
+        self.assertEqual(other, "projects/ubuntu-os-cloud/global/images/ubuntu-1804-lts-v2")
+        self.assertEqual(images.calls, 2)
+
+
+class TestDiscoveryDoc(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        gcloud._discovery_docs.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        gcloud._discovery_docs.clear()
+
+    def test_read_from_cache_dir(self):
+        with open(os.path.join(self.cache_dir, "compute.v1.json"), "w") as f:
+            f.write('{"name": "compute"}')
+        self.assertEqual(gcloud.get_discovery_doc("compute", "v1", self.cache_dir), '{"name": "compute"}')
+        os.remove(os.path.join(self.cache_dir, "compute.v1.json"))
+        # kept in memory after the first read
+        self.assertEqual(gcloud.get_discovery_doc("compute", "v1", self.cache_dir), '{"name": "compute"}')
+
+
+class TestGcloudProjConfig(unittest.TestCase):
+
+    def test_nothing_loaded_until_used(self):
+        attrs = GcloudProjConfig("broad-dsde-dev", {"SVC_ACCT_PATH": "/nonexistent.json", "ZONE": "us-central1-a",
+                                                    "WARM_POOL_SIZE": "2"})
+        self.assertEqual(attrs.zone, "us-central1-a")
+        self.assertEqual(attrs.image_family, "ubuntu-1604-lts")
+        self.assertEqual(attrs.warm_pool_size, 2)
+        with self.assertRaises(Exception):
+            attrs.credentials
+
+
+class FakeHttp:
+
+    def __init__(self, log):
+        self.log = log
+
+    def request(self, uri, method="GET", **kwargs):
+        self.log.append(self)
+        return {"status": "200"}, "{}"
+
+
+class FakeCredentials:
+
+    def __init__(self):
+        self.log = []
+        self.authorized = 0
+
+    def authorize(self, http):
+        self.authorized += 1
+        return FakeHttp(self.log)
+
+
+class TestPooledHttp(unittest.TestCase):
+
+    def test_connections_reused(self):
+        credentials = FakeCredentials()
+        http = gcloud.PooledHttp(credentials, size=2)
+        for _ in range(5):
+            http.request("https://compute.googleapis.com")
+        self.assertEqual(credentials.authorized, 1)
+        self.assertEqual(len(set(credentials.log)), 1)
+
+    def test_bounded_across_threads(self):
+        credentials = FakeCredentials()
+        http = gcloud.PooledHttp(credentials, size=2)
+        threads = [threading.Thread(target=http.request, args=("https://compute.googleapis.com",)) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(credentials.authorized, 2)
+        self.assertEqual(len(credentials.log), 10)
+
+
+class TestCheckRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckRequest()
+        self.body = {"name": u"hermione", "ip": u"10.0.0.1", "project": u"broad-dsde-dev", "in_use": False}
+
+    def test_valid_create(self):
+        self.assertEqual(self.checker.check_request_create(self.body), "")
+
+    def test_every_string_type_accepted(self):
+        self.body["name"] = "hermione"
+        self.assertEqual(self.checker.check_request_create(self.body), "")
+
+    def test_missing_and_bad_types(self):
+        del self.body["ip"]
+        self.body["in_use"] = 1
+        errors = self.checker.check_request_create(self.body)
+        self.assertIn("missing following fields: ['ip']", errors)
+        self.assertIn("incorrectly typed ['in_use']", errors)
+
+    def test_update_immutable(self):
+        errors = self.checker.check_request_update({"project": u"other", "usable": True})
+        self.assertIn("cannot be updated: ['project']", errors)
+
+    def test_bulk(self):
+        bad = dict(self.body, usable="yes")
+        errors = self.checker.check_requests_create([self.body, bad, "not a body", self.body])
+        self.assertEqual(sorted(errors), [1, 2])
+
+    def test_labels(self):
+        self.body["labels"] = {u"machine_type": u"n1-standard-8", u"tags": [u"gpu"]}
+        self.assertEqual(self.checker.check_request_create(self.body), "")
+        self.body["labels"] = {u"gpus": 2}
+        self.assertIn("incorrectly typed ['labels']", self.checker.check_request_create(self.body))
+
+    def test_gcloud_fields(self):
+        checker = CheckRequestGcloud()
+        body = {"name": u"hermione", "project": u"broad-dsde-dev", "zone": u"us-central1-a", "in_use": False, "tags": "x"}
+        self.assertIn("incorrectly typed ['tags']", checker.check_request_create(body))
+        body["tags"] = [u"x"]
+        self.assertEqual(checker.check_request_create(body), "")
+
+
+class TestLabelSelector(unittest.TestCase):
+
+    def test_equality_and_sets(self):
+        self.assertEqual(parse_selector("machine_type=n1-standard-8, tags in (gpu, ssd)"),
+                         [("machine_type", "in", ["n1-standard-8"]), ("tags", "in", ["gpu", "ssd"])])
+
+    def test_negations_and_existence(self):
+        self.assertEqual(parse_selector("env!=prod,zone notin (us-east1-b),gpu,!retired"),
+                         [("env", "notin", ["prod"]), ("zone", "notin", ["us-east1-b"]),
+                          ("gpu", "exists", []), ("retired", "absent", [])])
+
+    def test_empty(self):
+        self.assertEqual(parse_selector(""), [])
+        self.assertEqual(parse_selector(None), [])
+
+    def test_malformed(self):
+        for selector in ["tags in gpu", "tags in ()", "=gpu", "a=b c"]:
+            with self.assertRaises(ValueError):
+                parse_selector(selector)
+
+    def test_clause_uses_indexable_operators(self):
+        # label containment is postgres only, so the clause is checked as compiled rather than run
+        clause = selector_clause(parse_selector("tags=gpu,!retired")).compile(dialect=postgresql.dialect())
+        self.assertEqual(str(clause), "(resources.labels @> %(param_1)s OR resources.labels @> %(param_2)s) "
+                                      "AND NOT resources.labels ? %(param_3)s")
+        self.assertEqual(clause.params, {"param_1": {"tags": "gpu"}, "param_2": {"tags": ["gpu"]}, "param_3": "retired"})
+
+
+class FakePoolMethods:
+    """Records the warm pool's bulk calls; names in `failing` report an error."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.actions = []
+        self.created = []
+
+    def bulk_action(self, action, names, project=None):
+        self.actions.append((action, sorted(names)))
+        self.stopping = sorted(r.name for r in Resource.query.filter(Resource.stopping_since != None))
+        return dict((n, "failed" if n in self.failing else None) for n in names)
+
+    def create_resources(self, bodies):
+        self.created.extend(bodies)
+        return dict((b["name"], None) for b in bodies)
+
+
+class DbTestCase(unittest.TestCase):
+    """Runs each test against a fresh in-memory sqlite resources table."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = Flask(__name__)
+        cls.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        cls.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(cls.app)
+
+    def setUp(self):
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def add(self, name, usable=True, released_minutes_ago=None, project="broad-dsde-dev", in_use=False, **columns):
+        r = Resource(name, "0.0.0.0", in_use, project, usable=usable)
+        if released_minutes_ago is not None:
+            r.released_at = datetime.datetime.now() - datetime.timedelta(minutes=released_minutes_ago)
+        for column, value in columns.items():
+            setattr(r, column, value)
+        db.session.add(r)
+        db.session.commit()
+        return r.id
+
+    def row(self, name, project="broad-dsde-dev"):
+        return Resource.query.filter_by(name=name, project=project).first()
+
+    def in_use(self):
+        return sorted(r.name for r in Resource.query.filter_by(in_use=True))
+
+
+class FakeInstances:
+    """Stands in for compute.instances() of a project holding the instances named in `names`,
+    each RUNNING unless `statuses` says otherwise."""
+
+    def __init__(self, names, statuses=None):
+        self.names = set(names)
+        self.statuses = statuses or {}
+        self.lists = 0
+
+    def instance(self, name):
+        return {"name": name, "status": self.statuses.get(name, "RUNNING"), "zone": "zones/us-central1-a",
+                "machineType": "zones/us-central1-a/machineTypes/n1-standard-8",
+                "networkInterfaces": [{"accessConfigs": [{"natIP": "10.0.0.1"}]}]}
+
+    def get(self, project, zone, instance):
+        if instance not in self.names:
+            raise HttpError(httplib2.Response({"status": 404}), "Not found")
+        return FakeRequest(self.instance(instance))
+
+    def list(self, project, zone):
+        self.lists += 1
+        return FakeRequest({"items": [self.instance(n) for n in sorted(self.names)]})
+
+    def list_next(self, previous_request, previous_response):
+        return None
+
+    def action(self, instance):
+        if instance not in self.names:
+            return FakeFailedRequest(HttpError(httplib2.Response({"status": 404}), "Not found"))
+        return FakeRequest({"name": "op-" + instance})
+
+    def start(self, project, zone, instance):
+        return self.action(instance)
+
+    def stop(self, project, zone, instance):
+        return self.action(instance)
+
+    def delete(self, project, zone, instance):
+        return self.action(instance)
+
+
+class FakeFailedRequest:
+
+    def __init__(self, error):
+        self.error = error
+
+    def execute(self):
+        raise self.error
+
+
+class FakeBatch:
+    """Stands in for a batch http request, running each request it holds in turn."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        for request, request_id in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeGcloudConfig:
+    """Stands in for a GcloudConfig with a credentialed project per entry of `instances`
+    ({project: instance names}). `snapshot` is what the inventory lists, by default every instance."""
+    OPERATION_TIMEOUT = 5
+
+    def __init__(self, instances, snapshot=None, trust_db=False):
+        self.projects = dict((p, FakeProject(FakeCompute(operations=FakeZoneOperations(ticks=1),
+                                                          instances=FakeInstances(names))))
+                             for p, names in instances.items())
+        self.snapshot = snapshot if snapshot is not None else instances
+        self.trust_db = trust_db
+        self.lookup_pool = ThreadPoolExecutor(max_workers=2)
+        self.inventory = TTLCache(maxsize=4, ttl=60)
+        self.operation_poller = OperationPoller(self, min_interval=0.01)
+
+    def instance_names(self, project):
+        return frozenset(self.snapshot.get(project, ())) if project in self.projects else frozenset()
+
+
+class TestClaims(DbTestCase):
+
+    def test_only_free_resources_claimed(self):
+        self.add("held", in_use=True)
+        self.add("stopped", usable=False)
+        self.add("private", private=True)
+        self.add("free")
+        methods = ResourceMethods()
+        claimed = methods.claim_resource()
+        self.assertEqual(claimed.name, "free")
+        self.assertTrue(claimed.in_use)
+        self.assertIsNotNone(self.row("free").timestamp)
+        self.assertIsNone(methods.claim_resource())
+
+    def test_claims_within_a_project(self):
+        self.add("a", project="other-project")
+        methods = ResourceMethods()
+        self.assertIsNone(methods.claim_resource(project="broad-dsde-dev"))
+        self.assertEqual(methods.claim_resource(project="other-project").name, "a")
+
+
+    def test_batch_takes_what_is_free(self):
+        for name in ["a", "b"]:
+            self.add(name)
+        methods = ResourceMethods()
+        self.assertEqual(methods.claim_resources(3, all_or_nothing=True), [])
+        self.assertEqual(self.in_use(), [])
+        self.assertEqual(sorted(r.name for r in methods.claim_resources(3)), ["a", "b"])
+
+    def test_release_by_id(self):
+        ids = [self.add(name) for name in ["a", "b"]]
+        methods = ResourceMethods()
+        methods.claim_resources(2)
+        methods.release_resources(ids[:1])
+        self.assertEqual(self.in_use(), ["b"])
+        self.assertIsNone(self.row("a").timestamp)
+        self.assertIsNotNone(self.row("a").released_at)
+
+
+class TestLeases(DbTestCase):
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        for name in ["a", "b", "c"]:
+            self.add(name)
+        self.methods = ResourceMethods()
+
+    def test_claims_share_a_lease(self):
+        claimed = self.methods.claim_resources(2, lease_ttl=60)
+        self.assertEqual(len(set(r.lease_id for r in claimed)), 1)
+        self.assertIsNone(self.methods.claim_resource().lease_id)
+
+    def test_renew_and_release(self):
+        lease_id = self.methods.claim_resources(2, lease_ttl=60)[0].lease_id
+        expires = self.methods.renew_lease(lease_id, 600)
+        self.assertGreater(expires, datetime.datetime.now() + datetime.timedelta(seconds=300))
+        self.assertIsNone(self.methods.renew_lease("not-a-lease", 600))
+        self.assertEqual(self.methods.release_lease(lease_id), 2)
+        self.assertEqual(self.in_use(), [])
+        self.assertIsNone(self.row("a").lease_id)
+
+    def test_expired_leases_freed_and_not_renewed(self):
+        lease_id = self.methods.claim_resource(lease_ttl=60).lease_id
+        kept = self.methods.claim_resource(lease_ttl=60).name
+        Resource.query.filter_by(lease_id=lease_id).update(
+            {"lease_expires": datetime.datetime.now() - datetime.timedelta(seconds=1)})
+        db.session.commit()
+        self.assertIsNone(self.methods.renew_lease(lease_id, 60))
+        self.assertEqual(self.methods.expire_leases(), 1)
+        self.assertEqual(self.in_use(), [kept])
+
+
+class TestGcloudClaims(DbTestCase):
+
+    def test_rows_without_credentials_not_claimed(self):
+        for name in ["a", "b", "c"]:
+            self.add(name, project="removed-project")
+        self.add("d")
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": ["d"]}))
+        self.assertEqual(methods.claim_resource().name, "d")
+        self.assertIsNone(methods.claim_resource())
+        self.assertEqual(self.in_use(), ["d"])
+
+    def test_gone_instances_dropped_and_others_put_back(self):
+        self.add("gone")
+        self.add("unlisted")
+        self.add("listed")
+        # "unlisted" exists but is missing from the inventory snapshot, so it is looked up directly
+        config = FakeGcloudConfig({"broad-dsde-dev": ["unlisted", "listed"]}, snapshot={"broad-dsde-dev": ["listed"]})
+        methods = GcloudResourceMethods(config)
+        claimed = methods.claim_resources(3)
+        self.assertEqual(sorted(r.name for r in claimed), ["listed", "unlisted"])
+        self.assertIsNone(self.row("gone"))
+        self.assertEqual(self.in_use(), ["listed", "unlisted"])
+
+    def test_all_or_nothing_puts_everything_back(self):
+        self.add("a")
+        self.add("gone")
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": ["a"]}))
+        self.assertEqual(methods.claim_resources(2, all_or_nothing=True), [])
+        self.assertEqual(self.in_use(), [])
+        self.assertIsNone(self.row("a").timestamp)
+
+    def test_failed_lookup_releases_every_claimed_row(self):
+        self.add("a")
+        self.add("b")
+        config = FakeGcloudConfig({"broad-dsde-dev": ["a"]}, snapshot={})
+        config.projects["broad-dsde-dev"].compute.fake_instances = None
+        with self.assertRaises(Exception):
+            GcloudResourceMethods(config).claim_resources(2)
+        self.assertEqual(self.in_use(), [])
+
+
+class TestResourceLabels(DbTestCase):
+
+    def test_labels_stored_on_create(self):
+        ResourceMethods().create_resource({"name": "a", "ip": "0.0.0.0", "project": "broad-dsde-dev",
+                                           "labels": {"tags": ["gpu"]}})
+        self.assertEqual(self.row("a").map()["labels"], {"tags": ["gpu"]})
+
+    def test_gcloud_instances_labelled_with_what_they_are_made_of(self):
+        body = {"name": "a", "tags": ["gpu"], "disk_size": "200", "labels": {"team": "dsde"}}
+        methods = GcloudInstanceResourceMethods(FakeGcloudConfig({"broad-dsde-dev": []}), "broad-dsde-dev")
+        methods.label_instance(body)
+        self.assertEqual(body["labels"], {"team": "dsde", "tags": ["gpu"], "zone": "us-central1-a",
+                                          "machine_type": "n1-standard-8", "disk_type": "pd-ssd", "disk_size": "200"})
+
+
+class TestListings(DbTestCase):
+
+    def test_expired_allocations(self):
+        now = datetime.datetime.now()
+        self.add("fresh", in_use=True, timestamp=now)
+        self.add("old", in_use=True, timestamp=now - datetime.timedelta(hours=6))
+        self.add("recent", in_use=True, timestamp=now - datetime.timedelta(minutes=10))
+        methods = ResourceMethods()
+        self.assertEqual([r["name"] for r in methods.get_all_resources(in_use=True, expired=None)], ["old"])
+        self.assertEqual([r["name"] for r in methods.get_all_resources(in_use=True, expired=300)], ["old", "recent"])
+        self.assertEqual(len(methods.get_all_resources(in_use=True)), 3)
+
+
+    def test_keyset_pages(self):
+        for name in ["a", "b", "c", "d", "e"]:
+            self.add(name)
+        methods = ResourceMethods()
+        first = list(methods.iter_resources(limit=2))
+        self.assertEqual([r["name"] for _, r in first], ["a", "b"])
+        second = list(methods.iter_resources(after=first[-1][0], limit=2))
+        self.assertEqual([r["name"] for _, r in second], ["c", "d"])
+        self.assertEqual(decode_cursor(encode_cursor(second[-1][0])), second[-1][0])
+        with self.assertRaises(ValueError):
+            decode_cursor("not-a-cursor")
+
+    def test_gcloud_pages_filled_past_gone_instances(self):
+        for name in ["a", "gone-1", "gone-2", "b", "gone-3", "c", "d"]:
+            self.add(name)
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": ["a", "b", "c", "d"]}))
+        first = methods.iter_resources(limit=2)
+        self.assertEqual([r["name"] for _, r in first], ["a", "b"])
+        second = methods.iter_resources(after=first[-1][0], limit=2)
+        self.assertEqual([r["name"] for _, r in second], ["c", "d"])
+        self.assertEqual(methods.iter_resources(after=second[-1][0], limit=2), [])
+
+
+    def test_fields(self):
+        self.add("held", in_use=True, timestamp=datetime.datetime.now() - datetime.timedelta(minutes=5))
+        self.add("free")
+        methods = ResourceMethods()
+        rows = [r for _, r in methods.iter_resources(fields=["name", "time_running"])]
+        self.assertEqual([set(r) for r in rows], [{"name", "time_running"}] * 2)
+        self.assertTrue(rows[0]["time_running"].startswith("0:05:"))
+        self.assertEqual(rows[1]["time_running"], "None")
+
+    def test_gcloud_fields_without_name(self):
+        self.add("a")
+        self.add("gone")
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": ["a"]}))
+        self.assertEqual([r for _, r in methods.iter_resources(fields=["ip"])], [{"ip": "0.0.0.0"}])
+
+
+    def test_gcloud_inventory_listed_once(self):
+        self.add("a")
+        self.add("gone")
+        self.add("b", project="removed-project")
+        projects_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, projects_dir)
+        with open(os.path.join(projects_dir, "broad-dsde-dev.env"), "w") as f:
+            f.write("ZONE=us-central1-a\n")
+        self.addCleanup(setattr, GcloudConfig, "PROJECTS_DIR", GcloudConfig.PROJECTS_DIR)
+        GcloudConfig.PROJECTS_DIR = projects_dir
+        config = GcloudConfig()
+        instances = FakeInstances(["a"])
+        config.projects["broad-dsde-dev"]._compute = FakeCompute(instances=instances)
+        methods = GcloudResourceMethods(config)
+        for _ in range(2):
+            self.assertEqual([r["name"] for _, r in methods.iter_resources()], ["a"])
+        self.assertEqual(instances.lists, 1)
+
+
+class TestBulkActions(DbTestCase):
+
+    def test_results_per_name(self):
+        self.add("a")
+        self.add("b")
+        methods = ResourceMethods()
+        self.assertEqual(methods.bulk_action("stop", ["a", "missing"]), {"a": None, "missing": "Resource not found"})
+        self.assertFalse(self.row("a").usable)
+        self.assertTrue(self.row("b").usable)
+        methods.bulk_action("delete", ["a", "b"])
+        self.assertEqual(Resource.query.count(), 0)
+
+    def test_gcloud_failures_left_unchanged(self):
+        for name in ["a", "bad", "gone"]:
+            self.add(name, usable=False, ip=None)
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": ["a", "bad"]}))
+        results = methods.bulk_action("start", ["a", "bad", "gone", "missing"])
+        self.assertIsNone(results["a"])
+        self.assertIn("QUOTA_EXCEEDED", results["bad"])
+        self.assertIn("404", results["gone"])
+        self.assertEqual(results["missing"], "Resource not found")
+        self.assertTrue(self.row("a").usable)
+        self.assertEqual(self.row("a").ip, "10.0.0.1")
+        self.assertFalse(self.row("bad").usable)
+        self.assertFalse(self.row("gone").usable)
+
+    def test_gcloud_delete_of_gone_instance_removes_row(self):
+        self.add("gone")
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": []}))
+        self.assertEqual(methods.bulk_action("delete", ["gone"]), {"gone": None})
+        self.assertIsNone(self.row("gone"))
+
+    def test_gcloud_project_without_credentials(self):
+        self.add("a", project="removed-project")
+        methods = GcloudResourceMethods(FakeGcloudConfig({"broad-dsde-dev": []}))
+        self.assertIn("No gcloud credentials", methods.bulk_action("stop", ["a"])["a"])
+        self.assertTrue(self.row("a", project="removed-project").usable)
+
+
+class TestSearch(DbTestCase):
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        for name in ["api-1", "test-api-2", "api-3", "other"]:
+            self.add(name)
+        self.methods = ResourceMethods()
+
+    def names(self, keyword, **kwargs):
+        return [r["name"] for _, r in self.methods.search_resources(keyword, **kwargs)]
+
+    def test_modes(self):
+        self.assertEqual(self.names("api"), ["api-1", "test-api-2", "api-3"])
+        self.assertEqual(self.names("api", mode="prefix"), ["api-1", "api-3"])
+
+    def test_pages_and_fields(self):
+        first = list(self.methods.search_resources("api", limit=2, fields=["name"]))
+        self.assertEqual([r for _, r in first], [{"name": "api-1"}, {"name": "test-api-2"}])
+        self.assertEqual(self.names("api", after=first[-1][0], limit=2), ["api-3"])
+
+    def test_wildcards_escaped(self):
+        self.assertEqual(escape_like("50%_off\\"), "50\\%\\_off\\\\")
+
+
+class TestPoolCounts(DbTestCase):
+
+    def test_counts_by_project(self):
+        now = datetime.datetime.now()
+        self.add("free")
+        self.add("stopped", usable=False)
+        self.add("private", private=True)
+        self.add("held", in_use=True, timestamp=now)
+        self.add("lease-run-out", in_use=True, timestamp=now, lease_expires=now - datetime.timedelta(minutes=1))
+        self.add("timed-out", in_use=True, timestamp=now - datetime.timedelta(hours=6))
+        self.add("elsewhere", project="other-project")
+        self.assertEqual(ResourceMethods().pool_counts(),
+                         {"broad-dsde-dev": {"free": 1, "in_use": 3, "expired": 2},
+                          "other-project": {"free": 1, "in_use": 0, "expired": 0}})
+
+
+class TestGcloudLookups(DbTestCase):
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.add("a")
+        self.add("a", project="other-project")
+        self.add("a", project="removed-project")
+
+    def test_found_in_the_project_that_has_it(self):
+        config = FakeGcloudConfig({"broad-dsde-dev": [], "other-project": ["a"]})
+        self.assertEqual(GcloudResourceMethods(config).get_resource_by_name("a").project, "other-project")
+
+    def test_failed_project_skipped_if_another_has_it(self):
+        config = FakeGcloudConfig({"broad-dsde-dev": [], "other-project": ["a"]})
+        config.projects["broad-dsde-dev"].compute.fake_instances = None
+        self.assertEqual(GcloudResourceMethods(config).get_resource_by_name("a").project, "other-project")
+
+    def test_failure_raised_if_no_project_has_it(self):
+        config = FakeGcloudConfig({"broad-dsde-dev": [], "other-project": []})
+        config.projects["other-project"].compute.fake_instances = None
+        with self.assertRaises(Exception):
+            GcloudResourceMethods(config).get_resource_by_name("a")
+
+
+class TestApplyBatch(DbTestCase):
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.methods = ResourceMethods()
+        self.can_update = CheckRequest().if_can_update_attr
+
+    def body(self, name, **fields):
+        return dict({"name": name, "ip": "0.0.0.0", "project": "broad-dsde-dev", "in_use": False}, **fields)
+
+    def test_creates_updates_and_deletes_together(self):
+        self.add("old")
+        self.add("held", in_use=True, timestamp=datetime.datetime.now())
+        committed, results = self.methods.apply_batch([
+            {"op": "create", "body": self.body("new", usable=True)},
+            {"op": "update", "name": "held", "body": {"in_use": False}},
+            {"op": "delete", "name": "old"}], can_update=self.can_update)
+        self.assertTrue(committed)
+        self.assertEqual([r["status"] for r in results], [201, 200, 204])
+        self.assertTrue(self.row("new").usable)
+        self.assertFalse(self.row("held").in_use)
+        self.assertIsNone(self.row("held").timestamp)
+        self.assertIsNotNone(self.row("held").released_at)
+        self.assertIsNone(self.row("old"))
+
+    def test_one_failure_rolls_back_everything(self):
+        self.add("existing")
+        committed, results = self.methods.apply_batch([
+            {"op": "create", "body": self.body("new")},
+            {"op": "delete", "name": "existing"},
+            {"op": "delete", "name": "not-a-resource"}])
+        self.assertFalse(committed)
+        self.assertEqual([r["status"] for r in results], [201, 204, 404])
+        self.assertIsNone(self.row("new"))
+        self.assertIsNotNone(self.row("existing"))
+
+    def test_later_items_see_earlier_ones(self):
+        committed, results = self.methods.apply_batch([
+            {"op": "create", "body": self.body("a")},
+            {"op": "create", "body": self.body("a")},
+            {"op": "delete", "name": "a"},
+            {"op": "update", "name": "a", "body": {"usable": True}}])
+        self.assertFalse(committed)
+        self.assertEqual([r["status"] for r in results], [201, 409, 204, 404])
+
+    def test_ambiguous_name_needs_a_project(self):
+        self.add("a")
+        self.add("a", project="other-project")
+        committed, results = self.methods.apply_batch([{"op": "delete", "name": "a"}])
+        self.assertEqual(results[0]["status"], 409)
+        committed, results = self.methods.apply_batch([{"op": "delete", "name": "a", "project": "other-project"}])
+        self.assertTrue(committed)
+        self.assertIsNone(self.row("a", project="other-project"))
+        self.assertIsNotNone(self.row("a"))
+
+    def test_in_use_needs_a_usable_resource(self):
+        self.add("stopped", usable=False)
+        committed, results = self.methods.apply_batch([{"op": "update", "name": "stopped", "body": {"in_use": True}}],
+                                                      can_update=self.can_update)
+        self.assertFalse(committed)
+        self.assertEqual(results[0]["status"], 405)
+        self.assertFalse(self.row("stopped").in_use)
+
+    def test_gcloud_not_supported(self):
+        with self.assertRaises(NotImplementedError):
+            GcloudResourceMethods(FakeGcloudConfig({})).apply_batch([{"op": "delete", "name": "a"}])
+
+
+class TestWarmPool(DbTestCase):
+
+    def usable(self):
+        return sorted(r.name for r in Resource.query.filter_by(usable=True))
+
+    def test_shortfall_starts_stopped_then_creates(self):
+        self.add("warm-1")
+        self.add("stopped-1", usable=False)
+        methods = FakePoolMethods()
+        pool = WarmPool(self.app, methods, None, 3, create=True)
+        pool.balance_project("broad-dsde-dev", 3)
+        self.assertEqual(methods.actions, [("start", ["stopped-1"])])
+        self.assertEqual(len(methods.created), 1)
+        self.assertEqual(pool.stats["started"], 1)
+        self.assertEqual(pool.stats["created"], 1)
+
+    def test_surplus_stopped_after_cooldown(self):
+        self.add("recent", released_minutes_ago=1)
+        self.add("idle", released_minutes_ago=60)
+        self.add("never")
+        methods = FakePoolMethods()
+        pool = WarmPool(self.app, methods, None, 1, cooldown=3600)
+        pool.balance_project("broad-dsde-dev", 1)
+        self.assertEqual(methods.actions, [])
+
+        pool.cooldown = 0
+        pool.balance_project("broad-dsde-dev", 1)
+        self.assertEqual(methods.actions, [("stop", ["idle", "never"])])
+        self.assertEqual(self.usable(), ["recent"])
+        self.assertEqual(pool.stats["stopped"], 2)
+
+    def test_failed_stop_handed_back(self):
+        self.add("a", released_minutes_ago=30)
+        self.add("b", released_minutes_ago=20)
+        self.add("c", released_minutes_ago=10)
+        methods = FakePoolMethods(failing=["a"])
+        pool = WarmPool(self.app, methods, None, 1, cooldown=0)
+        pool.balance_project("broad-dsde-dev", 1)
+        self.assertEqual(methods.actions, [("stop", ["a", "b"])])
+        self.assertEqual(self.usable(), ["a", "c"])
+        self.assertEqual(pool.stats["stopped"], 1)
+
+    def test_marked_stopping_until_stopped(self):
+        self.add("a")
+        self.add("b")
+        methods = FakePoolMethods()
+        pool = WarmPool(self.app, methods, None, 1, cooldown=0)
+        pool.balance_project("broad-dsde-dev", 1)
+        self.assertEqual(methods.stopping, ["a"])
+        self.assertEqual(Resource.query.filter(Resource.stopping_since != None).count(), 0)
+
+
+class TestReconciler(DbTestCase):
+
+    def reconcile(self, instances, statuses=None):
+        config = FakeGcloudConfig({"broad-dsde-dev": instances})
+        config.projects["broad-dsde-dev"].compute.fake_instances.statuses = statuses or {}
+        return Reconciler(self.app, config).reconcile_project("broad-dsde-dev", config.projects["broad-dsde-dev"])
+
+    def test_rows_brought_in_line_with_google(self):
+        self.add("gone")
+        self.add("started", usable=False, labels={"team": "dsde"})
+        self.add("stopped", usable=True)
+        self.add("booting", usable=False)
+        self.add("elsewhere", project="other-project")
+        removed, updated = self.reconcile(["started", "stopped", "booting", "unregistered"],
+                                          statuses={"stopped": "TERMINATED", "booting": "STAGING"})
+        self.assertEqual(removed, 1)
+        self.assertIsNone(self.row("gone"))
+        self.assertIsNotNone(self.row("elsewhere", project="other-project"))
+        started = self.row("started")
+        self.assertTrue(started.usable)
+        self.assertEqual(started.ip, "10.0.0.1")
+        self.assertEqual(started.labels, {"team": "dsde", "tags": [], "machine_type": "n1-standard-8",
+                                          "zone": "us-central1-a"})
+        self.assertFalse(self.row("stopped").usable)
+        # mid-transition instances keep their usable flag
+        self.assertFalse(self.row("booting").usable)
+        self.assertIsNone(self.row("unregistered"))
+
+    def test_unchanged_rows_not_written(self):
+        self.add("a", usable=True)
+        self.assertEqual(self.reconcile(["a"]), (0, 1))
+        self.assertEqual(self.reconcile(["a"]), (0, 0))
+
+    def test_pending_stop_left_alone(self):
+        self.add("stopping", usable=False, stopping_since=datetime.datetime.now())
+        self.add("abandoned", usable=False, stopping_since=datetime.datetime.now() - datetime.timedelta(hours=1))
+        self.reconcile(["stopping", "abandoned"])
+        self.assertFalse(self.row("stopping").usable)
+        self.assertTrue(self.row("abandoned").usable)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        metrics = Metrics()
+        metrics.describe("requests_total", "counter", "Requests")
+        metrics.inc("requests_total", route="/a", status=200)
+        metrics.inc("requests_total", route="/a", status=200)
+        text = metrics.render()
+        self.assertIn("# TYPE requests_total counter", text)
+        self.assertIn('requests_total{route="/a",status="200"} 2', text)
+
+    def test_histogram(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.describe("latency_seconds", "histogram", "Latency")
+        metrics.observe("latency_seconds", 0.5, call="f")
+        metrics.observe("latency_seconds", 5, call="f")
+        text = metrics.render()
+        self.assertIn('latency_seconds_bucket{call="f",le="0.1"} 0', text)
+        self.assertIn('latency_seconds_bucket{call="f",le="1.0"} 1', text)
+        self.assertIn('latency_seconds_bucket{call="f",le="+Inf"} 2', text)
+        self.assertIn('latency_seconds_count{call="f"} 2', text)
+
+    def test_collectors_and_escaping(self):
+        metrics = Metrics()
+        metrics.add_collector(lambda: [("free", "gauge", "Free", [({"project": 'a"b'}, 3)])])
+        self.assertIn('free{project="a\\"b"} 3', metrics.render())
+
+    def outbound_metrics(self):
+        metrics = Metrics()
+        metrics.describe("jacalloc_outbound_call_duration_seconds", "histogram", "Latency")
+        metrics.describe("jacalloc_outbound_call_errors_total", "counter", "Errors")
+        return metrics
+
+    def test_timed_counts_errors(self):
+        metrics = self.outbound_metrics()
+
+        @metrics.timed
+        def flaky_call():
+            raise IOError("down")
+
+        with self.assertRaises(IOError):
+            flaky_call()
+        text = metrics.render()
+        self.assertIn('jacalloc_outbound_call_errors_total{call="flaky_call"} 1', text)
+        self.assertIn('jacalloc_outbound_call_duration_seconds_count{call="flaky_call"} 1', text)
+
+    def test_outbound_times_each_call(self):
+        metrics = self.outbound_metrics()
+        for _ in range(3):
+            with metrics.outbound("list_page"):
+                pass
+        text = metrics.render()
+        self.assertIn('jacalloc_outbound_call_duration_seconds_count{call="list_page"} 3', text)
+        self.assertNotIn('jacalloc_outbound_call_errors_total{call="list_page"}', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+AllocationQueue class
+
+Lets allocation requests wait for a resource to be released instead of failing
+immediately. Waiters are served in FIFO order per project and label selector, and
+are woken by Postgres LISTEN/NOTIFY on RELEASE_CHANNEL, with a periodic re-check
+as a fallback.
+"""
+from collections import deque
+import select
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+RELEASE_CHANNEL = 'resources_released'
+
+
+class AllocationQueue:
+
+    def __init__(self, poll_interval=5):
+        self.poll_interval = poll_interval
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def start(self, database_uri):
+        """Starts listening for release notifications when the database is postgres."""
+        if self._listener or not database_uri or not database_uri.startswith('postgres'):
+            return
+        self._listener = threading.Thread(target=self._listen, args=(database_uri,), name="allocation-listener")
+        self._listener.daemon = True
+        self._listener.start()
+
+    def _listen(self, database_uri):
+        while True:
+            try:
+                conn = psycopg2.connect(database_uri)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute("LISTEN " + RELEASE_CHANNEL)
+                while True:
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.notify(conn.notifies.pop(0).payload or None)
+            except Exception as e:
+                print "[WARN] Allocation listener lost its connection: {0}".format(e)
+                time.sleep(self.poll_interval)
+
+    def notify(self, project=None):
+        """Wakes the first waiter for `project` and the first waiter for any project.
+        A release without a project wakes the first waiter of every queue."""
+        with self._lock:
+            for (key, _), waiters in self._queues.items():
+                if waiters and (project is None or key in (project, None)):
+                    waiters[0].set()
+
+    def waiting(self, project=None):
+        with self._lock:
+            return sum(len(waiters) for (key, _), waiters in self._queues.items() if key == project)
+
+    def waiting_counts(self):
+        """{project: number of waiting allocations}; waiters for any project are under None."""
+        counts = {}
+        with self._lock:
+            for (key, _), waiters in self._queues.items():
+                counts[key] = counts.get(key, 0) + len(waiters)
+        return counts
+
+    def wait(self, claim, timeout, project=None, selector=None):
+        """Calls claim() in FIFO turn until it returns a result or `timeout` seconds pass.
+        Returns the claim result, or None if the wait timed out. Waiters with different
+        label selectors queue separately, so one that nothing matches does not hold up the rest."""
+        deadline = time.time() + timeout
+        event = threading.Event()
+        queue = (project, selector)
+        with self._lock:
+            waiters = self._queues.setdefault(queue, deque())
+            waiters.append(event)
+        try:
+            while True:
+                # only the head of the queue claims, so earlier requests are served first
+                if waiters[0] is event:
+                    result = claim()
+                    if result:
+                        return result
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                event.wait(min(remaining, self.poll_interval))
+                event.clear()
+        finally:
+            with self._lock:
+                waiters.remove(event)
+                if waiters:
+                    # pass the turn on; there may be more than one free resource
+                    waiters[0].set()
+                else:
+                    del self._queues[queue]
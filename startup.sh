@@ -1,8 +1,6 @@
 #!/usr/bin/env bash
 
 sleep 5
-python manage.py db init
-python manage.py db migrate
-python manage.py db upgrade
+python manage.py db upgrade || exit 1
 
 python app.py